@@ -0,0 +1,314 @@
+import os
+import gzip
+import json
+import zlib
+import struct
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Optional, Any, Dict, List, Tuple
+
+
+# Layout of kv::Input settings, in the order serde serializes the structs
+SETTINGS_LAYOUT = (
+    ('modes', ('whole_protein_mode', 'box_mode', 'resolution_mode', 'surface_mode', 'kvp_mode', 'ligand_mode')),
+    ('step_size', ('step_size',)),
+    ('probes', ('probe_in', 'probe_out')),
+    ('cutoffs', ('volume_cutoff', 'ligand_cutoff', 'removal_distance')),
+    ('visiblebox', ('p1', 'p2', 'p3', 'p4')),
+    ('internalbox', ('p1', 'p2', 'p3', 'p4')),
+)
+
+
+def job_tag(input: Dict[str, Any], encoded: Optional[Dict[str, str]]=None) -> str:
+    """ Tag given by kv::webserver::create to a job input (city::hash64 of its serde_json form) """
+    return str(city_hash64(server_json(input, encoded).encode()))
+
+
+def server_json(input: Dict[str, Any], encoded: Optional[Dict[str, str]]=None) -> str:
+    """ Input serialized as serde_json::to_string(&Input) does on the server
+
+    Floats are rounded to 15 significant digits: the server parses them without float_roundtrip (serde_json 1.0.62),
+    which can move a 17-digit value by one ulp and change the tag. Sending this form keeps both sides on the same value.
+
+    encoded: cache of the serialized pdb and pdb_ligand lists, filled on first use and reused afterwards
+    """
+    if encoded == None:
+        encoded = {}
+    sections = []
+    for section, keys in SETTINGS_LAYOUT:
+        values = []
+        for key in keys:
+            value = input['settings'][section][key]
+            if isinstance(value, dict):
+                value = '{' + ','.join(f'"{axis}":{_f64(value[axis])}' for axis in ('x', 'y', 'z')) + '}'
+            elif isinstance(value, bool):
+                value = 'true' if value else 'false'
+            elif isinstance(value, str):
+                value = json.dumps(value)
+            else:
+                value = _f64(value)
+            values.append(f'"{key}":{value}')
+        sections.append(f'"{section}":{{' + ','.join(values) + '}')
+    for key in ('pdb', 'pdb_ligand'):
+        if key not in encoded:
+            encoded[key] = _strings(input[key]) if input.get(key) != None else 'null'
+    # output_format is left out by the server when absent
+    output_format = f',"output_format":"{input["output_format"]}"' if input.get('output_format') != None else ''
+    return '{"settings":{' + ','.join(sections) + '},"pdb":' + encoded['pdb'] + ',"pdb_ligand":' + encoded['pdb_ligand'] + output_format + '}'
+
+
+def _strings(lines: List[str]) -> str:
+    # serde_json and json escape the same characters once non-ASCII is left as is
+    return json.dumps(lines, ensure_ascii=False, separators=(',', ':'))
+
+
+def _f64(value: float) -> str:
+    # serde_json prints f64 with ryu, which switches to exponents at other points than repr()
+    value = float(f'{float(value):.15g}')
+    sign, digits, exponent = Decimal(repr(value)).normalize().as_tuple()
+    digits = ''.join(map(str, digits))
+    length = len(digits)
+    kk = length + exponent
+    if 0 <= exponent and kk <= 16:
+        text = digits + '0' * exponent + '.0'
+    elif 0 < kk <= 16:
+        text = digits[:kk] + '.' + digits[kk:]
+    elif -5 < kk <= 0:
+        text = '0.' + '0' * -kk + digits
+    elif length == 1:
+        text = f'{digits}e{kk - 1}'
+    else:
+        text = f'{digits[0]}.{digits[1:]}e{kk - 1}'
+    return '-' + text if sign else text
+
+
+# CityHash64 (v1.1), as bundled by the fasthash crate
+_MASK = 0xffffffffffffffff
+_K0 = 0xc3a5c85c97cb3127
+_K1 = 0xb492b66fbe98f273
+_K2 = 0x9ae16a3b2f90404f
+_KMUL = 0x9ddfea08eb382d69
+
+
+def _rotate(value: int, shift: int) -> int:
+    if shift == 0:
+        return value
+    return ((value >> shift) | (value << (64 - shift))) & _MASK
+
+
+def _shift_mix(value: int) -> int:
+    return value ^ (value >> 47)
+
+
+def _bswap(value: int) -> int:
+    return int.from_bytes(value.to_bytes(8, 'little'), 'big')
+
+
+def _hash_len16(u: int, v: int, mul: int=_KMUL) -> int:
+    a = ((u ^ v) * mul) & _MASK
+    a ^= a >> 47
+    b = ((v ^ a) * mul) & _MASK
+    b ^= b >> 47
+    return (b * mul) & _MASK
+
+
+def _fetch64(s: bytes, i: int) -> int:
+    return struct.unpack_from('<Q', s, i)[0]
+
+
+def _fetch32(s: bytes, i: int) -> int:
+    return struct.unpack_from('<I', s, i)[0]
+
+
+def _hash_len0to16(s: bytes) -> int:
+    length = len(s)
+    if length >= 8:
+        mul = _K2 + length * 2
+        a = (_fetch64(s, 0) + _K2) & _MASK
+        b = _fetch64(s, length - 8)
+        c = (_rotate(b, 37) * mul + a) & _MASK
+        d = ((_rotate(a, 25) + b) * mul) & _MASK
+        return _hash_len16(c, d, mul)
+    if length >= 4:
+        mul = _K2 + length * 2
+        a = _fetch32(s, 0)
+        return _hash_len16((length + (a << 3)) & _MASK, _fetch32(s, length - 4), mul)
+    if length > 0:
+        y = (s[0] + (s[length >> 1] << 8)) & 0xffffffff
+        z = (length + (s[length - 1] << 2)) & 0xffffffff
+        return (_shift_mix(((y * _K2) ^ (z * _K0)) & _MASK) * _K2) & _MASK
+    return _K2
+
+
+def _hash_len17to32(s: bytes) -> int:
+    length = len(s)
+    mul = _K2 + length * 2
+    a = (_fetch64(s, 0) * _K1) & _MASK
+    b = _fetch64(s, 8)
+    c = (_fetch64(s, length - 8) * mul) & _MASK
+    d = (_fetch64(s, length - 16) * _K2) & _MASK
+    return _hash_len16(
+        (_rotate((a + b) & _MASK, 43) + _rotate(c, 30) + d) & _MASK,
+        (a + _rotate((b + _K2) & _MASK, 18) + c) & _MASK,
+        mul,
+    )
+
+
+def _hash_len33to64(s: bytes) -> int:
+    length = len(s)
+    mul = _K2 + length * 2
+    a = (_fetch64(s, 0) * _K2) & _MASK
+    b = _fetch64(s, 8)
+    c = _fetch64(s, length - 24)
+    d = _fetch64(s, length - 32)
+    e = (_fetch64(s, 16) * _K2) & _MASK
+    f = (_fetch64(s, 24) * 9) & _MASK
+    g = _fetch64(s, length - 8)
+    h = (_fetch64(s, length - 16) * mul) & _MASK
+    u = (_rotate((a + g) & _MASK, 43) + (_rotate(b, 30) + c) * 9) & _MASK
+    v = (((a + g) & _MASK ^ d) + f + 1) & _MASK
+    w = (_bswap(((u + v) * mul) & _MASK) + h) & _MASK
+    x = (_rotate((e + f) & _MASK, 42) + c) & _MASK
+    y = ((_bswap(((v + w) * mul) & _MASK) + g) * mul) & _MASK
+    z = (e + f + c) & _MASK
+    a = (_bswap(((x + z) * mul + y) & _MASK) + b) & _MASK
+    b = (_shift_mix(((z + a) * mul + d + h) & _MASK) * mul) & _MASK
+    return (b + x) & _MASK
+
+
+def _weak_hash_len32_with_seeds(s: bytes, i: int, a: int, b: int) -> Tuple[int, int]:
+    w, x, y, z = struct.unpack_from('<4Q', s, i)
+    a = (a + w) & _MASK
+    b = _rotate((b + a + z) & _MASK, 21)
+    c = a
+    a = (a + x + y) & _MASK
+    b = (b + _rotate(a, 44)) & _MASK
+    return (a + z) & _MASK, (b + c) & _MASK
+
+
+def city_hash64(s: bytes) -> int:
+    length = len(s)
+    if length <= 16:
+        return _hash_len0to16(s)
+    if length <= 32:
+        return _hash_len17to32(s)
+    if length <= 64:
+        return _hash_len33to64(s)
+
+    # for strings over 64 bytes, hash the end first and then loop over 64-byte chunks
+    x = _fetch64(s, length - 40)
+    y = (_fetch64(s, length - 16) + _fetch64(s, length - 56)) & _MASK
+    z = _hash_len16((_fetch64(s, length - 48) + length) & _MASK, _fetch64(s, length - 24))
+    v = _weak_hash_len32_with_seeds(s, length - 64, length, z)
+    w = _weak_hash_len32_with_seeds(s, length - 32, (y + _K1) & _MASK, x)
+    x = (x * _K1 + _fetch64(s, 0)) & _MASK
+
+    for i in range(0, (length - 1) & ~63, 64):
+        _, s1, s2, _, _, s5, s6, _ = struct.unpack_from('<8Q', s, i)
+        x = (_rotate((x + y + v[0] + s1) & _MASK, 37) * _K1) & _MASK
+        y = (_rotate((y + v[1] + s6) & _MASK, 42) * _K1) & _MASK
+        x ^= w[1]
+        y = (y + v[0] + s5) & _MASK
+        z = (_rotate((z + w[0]) & _MASK, 33) * _K1) & _MASK
+        v = _weak_hash_len32_with_seeds(s, i, (v[1] * _K1) & _MASK, (x + w[0]) & _MASK)
+        w = _weak_hash_len32_with_seeds(s, i + 32, (z + w[1]) & _MASK, (y + s2) & _MASK)
+        z, x = x, z
+
+    return _hash_len16(
+        (_hash_len16(v[0], w[0]) + _shift_mix(y) * _K1 + z) & _MASK,
+        (_hash_len16(v[1], w[1]) + x) & _MASK,
+    )
+
+
+class ResultStore(object):
+    """ Completed job replies kept on disk, one gzip JSON file per job tag
+
+    max_bytes: budget for the compressed entries, least recently used ones are evicted first (None is unbounded)
+    """
+
+    suffix = '.json.gz'
+
+    def __init__(self, directory: str, max_bytes: Optional[int]=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        # tag -> entry size, from least to most recently used
+        self._index: 'OrderedDict[str, int]' = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, tag: str) -> str:
+        return os.path.join(self.directory, tag + self.suffix)
+
+    def _load_index(self) -> None:
+        # access order survives restarts through the entries modification time
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.suffix):
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name[:-len(self.suffix)], st.st_size))
+        for _, tag, size in sorted(entries):
+            self._index[tag] = size
+            self.size += size
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, tag: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if tag not in self._index:
+                return None
+            self._index.move_to_end(tag)
+        try:
+            with open(self._path(tag), 'rb') as f:
+                data = f.read()
+            os.utime(self._path(tag))
+        except FileNotFoundError:
+            self._discard(tag)
+            return None
+        try:
+            return json.loads(gzip.decompress(data))
+        except (OSError, EOFError, ValueError, zlib.error):
+            # corrupt or truncated entry, dropped so the job runs again and replaces it
+            try:
+                os.remove(self._path(tag))
+            except FileNotFoundError:
+                pass
+            self._discard(tag)
+            return None
+
+    def put(self, tag: str, reply: Dict[str, Any]) -> None:
+        data = gzip.compress(json.dumps(reply).encode(), compresslevel=6)
+        if self.max_bytes != None and len(data) > self.max_bytes:
+            return
+        # write then rename, so an interrupted run never leaves a truncated entry
+        tmp = f'{self._path(tag)}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(tag))
+        with self._lock:
+            self.size += len(data) - self._index.pop(tag, 0)
+            self._index[tag] = len(data)
+            evicted = self._evict()
+        for old in evicted:
+            try:
+                os.remove(self._path(old))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> List[str]:
+        evicted = []
+        while self.max_bytes != None and self.size > self.max_bytes:
+            tag, size = self._index.popitem(last=False)
+            self.size -= size
+            evicted.append(tag)
+        return evicted
+
+    def _discard(self, tag: str) -> None:
+        with self._lock:
+            self.size -= self._index.pop(tag, 0)
@@ -1,25 +1,72 @@
+import os
 import json
-from typing import Optional, Any, Dict
+import copy
+import random
+import asyncio
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional, Any, Callable, Dict, IO, Iterable, Iterator, AsyncIterator, Tuple, List, Union
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import zlib
-from time import sleep
+from time import sleep, perf_counter, monotonic
+from structure import load_pdb, get_pdb_boundaries, iter_structures
+from cache import ResultStore, SETTINGS_LAYOUT, server_json, city_hash64
+from results import ParsedOutput, pdb_kv_text
+
+# section of each setting that can be set by name (box points are set through the box dictionaries)
+SETTINGS_SECTIONS = {key: section for section, keys in SETTINGS_LAYOUT if not section.endswith('box') for key in keys}
+
+# job phases timed by KVJob and KVClient, in seconds
+PHASES = ('build', 'serialize', 'upload', 'queue', 'run', 'download', 'decode')
+
+# errors that end a single job of a batch: requests out of retries, unreadable store entries
+JOB_ERRORS = (requests.RequestException, OSError, EOFError, ValueError, zlib.error)
 
 class KVJob:
-    def __init__(self, path_protein_pdb: str, path_ligand_pdb: Optional[str]=None):
+    def __init__(self, path_protein_pdb: Union[str, IO[str]], path_ligand_pdb: Optional[str]=None, hydrogens: bool=True, waters: bool=True, compact: bool=False):
+        start = perf_counter()
         self.id: Optional[str] = None
         self.input: Optional[Dict[str, Any]] = {}
-        self.output: Optional[Dict[str, Any]] = None 
-        self._add_pdb(path_protein_pdb)
+        self.output: Optional[Dict[str, Any]] = None
+        # output files, by output name, when the client streamed them to disk instead of keeping output
+        self.paths: Optional[Dict[str, str]] = None
+        # seconds spent in each of PHASES (and submit, total), see write_timings
+        self.latencies: Dict[str, float] = {}
+        # settings changed through configure or sweep
+        self.parameters: Dict[str, Any] = {}
+        # bytes of records not sent to the server (REMARK, CONECT, other models...)
+        self.bytes_saved: int = 0
+        # serialized pdb and pdb_ligand, copied to the jobs of a sweep
+        self._encoded: Dict[str, str] = {}
+        self._add_pdb(path_protein_pdb, hydrogens=hydrogens, waters=waters)
         if path_ligand_pdb != None:
-            self._add_pdb(path_ligand_pdb, is_ligand=True)
+            self._add_pdb(path_ligand_pdb, is_ligand=True, hydrogens=hydrogens, waters=waters)
         self._default_settings()
+        if compact:
+            # cavities come back as pdb_kv_compact arrays instead of pdb_kv text
+            self.input["output_format"] = "Compact"
+        self.latencies['build'] = perf_counter() - start
+
+    @property
+    def output(self) -> Optional[Dict[str, Any]]:
+        return self._output
+
+    @output.setter
+    def output(self, output: Optional[Dict[str, Any]]) -> None:
+        # a new reply drops whatever was parsed from the previous one
+        self._output = output
+        self._parsed = ParsedOutput(output["output"]) if output != None and output.get("output") != None else None
 
     @property
     def kv_pdb(self):
         if self.output == None:
             return None
         else:
-            return self.output["output"]["pdb_kv"]
+            return pdb_kv_text(self.output["output"])
 
     @property
     def report(self):
@@ -35,14 +82,85 @@ class KVJob:
         else:
             return self.output["output"]["log"]
 
-    def _add_pdb(self, pdb_fn: str, is_ligand: bool=False):
-        with open(pdb_fn) as f:
-            pdb = f.readlines()
+    @property
+    def parsed_report(self) -> Optional[Dict[str, Any]]:
+        """ Report as a dictionary, parsed once """
+        return self._parsed.report if self._parsed != None else None
+
+    @property
+    def cavities(self) -> Optional['numpy.ndarray']:
+        """ Cavity points of pdb_kv or pdb_kv_compact as a structured array (see results.CAVITY_DTYPE), parsed once """
+        return self._parsed.cavities if self._parsed != None else None
+
+    def release(self) -> None:
+        """ Keep only the parsed report and cavities, kv_pdb and report are None afterwards """
+        if self._parsed != None:
+            self._parsed.release()
+
+    @property
+    def n_atoms(self) -> int:
+        return sum(1 for line in self.input["pdb"] if line.startswith(("ATOM", "HETATM")))
+
+    @property
+    def tag(self) -> str:
+        """ Job id the server gives to this input """
+        return str(city_hash64(self.payload()))
+
+    def payload(self) -> bytes:
+        """ Input as sent to /create, in the compact form the server hashes into the job tag """
+        return server_json(self.input, self._encoded).encode()
+
+    def configure(self, **parameters) -> 'KVJob':
+        """ Set settings by name, e.g. configure(probe_out=6.0, removal_distance=1.2) """
+        for name, value in parameters.items():
+            if name not in SETTINGS_SECTIONS:
+                raise KeyError(f"Unknown setting: {name}")
+            self.input["settings"][SETTINGS_SECTIONS[name]][name] = value
+            self.parameters[name] = value
+        return self
+
+    def copy(self) -> 'KVJob':
+        """ New job with its own settings, sharing the structure already read """
+        kv_job = copy.copy(self)
+        kv_job.id = None
+        kv_job.output = None
+        kv_job.paths = None
+        kv_job.latencies = {}
+        kv_job.parameters = dict(self.parameters)
+        # serialized structures carried over, but a structure replaced in one copy is not seen by the others
+        kv_job._encoded = dict(self._encoded)
+        kv_job.input = dict(self.input)
+        kv_job.input["settings"] = copy.deepcopy(self.input["settings"])
+        return kv_job
+
+    @classmethod
+    def sweep(cls, path_protein_pdb: str, path_ligand_pdb: Optional[str]=None, **grid) -> List['KVJob']:
+        """ One job per point of the cartesian product of the given setting lists
+
+        e.g. KVJob.sweep(pdb, probe_out=[4.0, 6.0, 8.0], removal_distance=[0.0, 2.4]); the structure is
+        read and serialized once for all of them.
+        """
+        base = cls(path_protein_pdb, path_ligand_pdb)
+        if path_ligand_pdb != None:
+            base.input["settings"]["modes"]["ligand_mode"] = True
+        # serialize the structure before copying, so every job starts with it
+        base.payload()
+        names = list(grid)
+        return [base.copy().configure(**dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+    def _add_pdb(self, pdb_fn: Union[str, IO[str]], is_ligand: bool=False, **filters):
+        pdb, stats = load_pdb(pdb_fn, **filters)
+        self.bytes_saved += stats['bytes_saved']
+        self._encoded.pop("pdb_ligand" if is_ligand else "pdb", None)
         if is_ligand:
             self.input["pdb_ligand"] = pdb
         else:
             self.input["pdb"] = pdb
 
+    def check(self) -> None:
+        """ Raise ValueError with the message the server would reply for invalid settings """
+        check_input(self.input)
+
     def _default_settings(self):
         self.input["settings"] = {}
         self.input["settings"]["modes"] = {
@@ -76,19 +194,311 @@ class KVJob:
             "p4" : {"x" : -4.00, "y" : -4.00, "z" : 4.00},
         }
 
+def check_input(input: Dict[str, Any]) -> None:
+    """ Same checks, in the same order, as kv::Input::check on the server """
+    settings = input["settings"]
+    modes, probes, cutoffs = settings["modes"], settings["probes"], settings["cutoffs"]
+    # Compare Whole protein and Box modes
+    if modes["whole_protein_mode"] == modes["box_mode"]:
+        raise ValueError("Invalid parameters file! Whole protein and box modes cannot be equal!")
+    # Compare resolution mode
+    if modes["resolution_mode"] != "Low":
+        raise ValueError("Invalid parameters file! Resolution mode is restricted to Low option on this web service!")
+    # Probe In
+    if probes["probe_in"] < 0.0 or probes["probe_in"] > 5.0:
+        raise ValueError("Invalid parameters file! Probe In must be between 0 and 5!")
+    # Probe Out
+    if probes["probe_out"] < 0.0 or probes["probe_out"] > 50.0:
+        raise ValueError("Invalid parameters file! Probe Out must be between 0 and 50!")
+    # Compare probes
+    if probes["probe_out"] < probes["probe_in"]:
+        raise ValueError("Invalid parameters file! Probe Out must be greater than Probe In!")
+    # Removal distance
+    if cutoffs["removal_distance"] < 0.0 or cutoffs["removal_distance"] > 10.0:
+        raise ValueError("Invalid parameters file! Removal distance must be between 0 and 10!")
+    # Volume Cutoff
+    if cutoffs["volume_cutoff"] < 0.0:
+        raise ValueError("Invalid parameters file! Volume cutoff must be greater than 0!")
+    # Cavity representation
+    if modes["kvp_mode"]:
+        raise ValueError("Invalid parameters file! Cavity Representation (kvp_mode) must be false on this webservice!")
+    # Ligand mode and pdb
+    has_ligand = input.get("pdb_ligand") != None
+    if modes["ligand_mode"] and not has_ligand:
+        raise ValueError("Invalid parameters file! A ligand must be provided when Ligand mode is set to true!")
+    elif not modes["ligand_mode"] and has_ligand:
+        raise ValueError("Invalid parameters file! The Ligand mode must be set to true when providing a ligand!")
+    # Ligand Cutoff
+    if cutoffs["ligand_cutoff"] <= 0.0:
+        raise ValueError("Invalid parameters file! Ligand cutoff must be greater than 0!")
+    # Box inside pdb grid
+    if modes["box_mode"]:
+        boundaries = get_pdb_boundaries(input["pdb"], padding=probes["probe_out"] + 20.0)
+        if boundaries == None:
+            raise ValueError("parsing error")
+        lower, upper = boundaries
+        box = settings["internalbox"]
+        points = [[box[p]["x"], box[p]["y"], box[p]["z"]] for p in ("p1", "p2", "p3", "p4")]
+        if any(c < lower[i] or c > upper[i] for point in points for i, c in enumerate(point)):
+            raise ValueError("Invalid parameters file! Inconsistent box coordinates!")
+
+
+def predict_runtime(n_atoms: int, probe_out: float) -> float:
+    """ Expected parKVFinder run time (s) on one kv-worker """
+    # least squares fit of elapsed_time in results/time-statistics.txt (1 kv-worker),
+    # elapsed time grows linearly with the number of atoms and the slope with probe_out
+    return max(0.0, n_atoms * (5.84e-5 + 1.23e-4 * probe_out) - 0.24)
+
+
+class PollSchedule:
+    """ Delays (s) between status checks of a single job """
+
+    def __init__(self, expected_runtime: Optional[float]=None, queued_delay: float=2.0, queued_max: float=60.0, 
+                 running_delay: float=0.5, running_max: float=10.0, factor: float=2.0, jitter: float=0.25):
+        self.expected_runtime = expected_runtime
+        self.queued_delay = queued_delay
+        self.queued_max = queued_max
+        self.running_delay = running_delay
+        self.running_max = running_max
+        self.factor = factor
+        self.jitter = jitter
+        self._queued_checks = 0
+        self._running_since: Optional[float] = None
+
+    def first(self) -> float:
+        # a job is never done before its expected run time
+        if self.expected_runtime != None:
+            return self._jittered(max(self.running_delay, self.expected_runtime))
+        return self._jittered(self.running_delay)
+
+    def next(self, status: Optional[str]) -> float:
+        if status == 'running':
+            return self._jittered(self._running())
+        # queued or unknown: exponential backoff
+        delay = min(self.queued_max, self.queued_delay * self.factor ** self._queued_checks)
+        self._queued_checks += 1
+        return self._jittered(delay)
+
+    def _running(self) -> float:
+        if self._running_since == None:
+            self._running_since = monotonic()
+        elapsed = monotonic() - self._running_since
+        if self.expected_runtime != None and self.expected_runtime > elapsed:
+            return max(self.running_delay, self.expected_runtime - elapsed)
+        # overdue or unknown run time: check again after a quarter of the time spent running
+        return min(self.running_max, max(self.running_delay, 0.25 * elapsed))
+
+    def _jittered(self, delay: float) -> float:
+        return delay * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+
 class KVClient:
-    def __init__(self, server: str, port="80"):
-        self.server = f"{server}:{port}"
+    # ocypod states after which a job will not change anymore (not_found: expired or unknown id)
+    terminal_status = ('completed', 'failed', 'timed_out', 'cancelled', 'not_found')
+    # ids per POST /status request (STATUS_LIMIT on the server)
+    status_batch = 1000
+    # files written by download, formatted with the base name
+    output_files = {'pdb_kv': '{}.KVFinder.output.pdb', 'report': '{}.KVFinder.results.toml', 'log': 'KVFinder.log'}
+    chunk_size = 1 << 16
+    # bodies over payload_limit (PAYLOAD_LIMIT on the server), or decoding to more than json_limit (JSON_LIMIT),
+    # are sent as upload_chunk sized parts instead, upload_workers at a time
+    payload_limit = 1_000_000
+    json_limit = 8_000_000
+    upload_chunk = 1 << 19
+    upload_workers = 4
 
-    def run(self, kv_job: KVJob):
-        if self._submit(kv_job):
-            while kv_job.output == None:
-                kv_job.output = self._get_results(kv_job)
-                sleep(2)
+    def __init__(self, server: str, port="80", pool_size: int=10, timeout: Tuple[float, float]=(5.0, 30.0), retries: int=3, keep_alive: bool=True, compress: bool=True, store: Optional[ResultStore]=None, wait_timeout: int=30, hooks: Iterable[Callable[[KVJob, str, float], None]]=()):
+        # port=None takes server as the full base url
+        self.server = f"{server}:{port}" if port != None else server
+        # called as hook(kv_job, phase, seconds) whenever a phase is timed, from the thread doing the request
+        self.hooks = list(hooks)
+        # seconds the server may hold a GET /{id}/wait request (WAIT_LIMIT on the server)
+        self.wait_timeout = wait_timeout
+        # completed results by job tag, checked before anything is sent to the server
+        self.store = store
+        # send gzip request bodies (the server limit applies to the compressed size)
+        self.compress = compress
+        # (connect, read) timeouts in seconds for every request
+        self.timeout = timeout
+        self.session = self._create_session(pool_size, retries, keep_alive)
+        # cleared when the server does not offer POST /status or GET /{id}/wait
+        self._bulk_status = True
+        self._long_poll = wait_timeout > 0
+        # cleared when the server does not offer chunked uploads
+        self._chunked_upload = True
+
+    @staticmethod
+    def _create_session(pool_size: int, retries: int, keep_alive: bool) -> requests.Session:
+        """ Session reusing up to `pool_size` connections, retrying connection errors and 5xx replies """
+        # /create is safe to retry: the server returns the existing job for an identical input
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'POST', 'PUT']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, kv_job: KVJob, out_dir: Optional[str]=None, base_name: str='job'):
+        """ Submit a job and wait for it, keeping its output in kv_job.output
+
+        With out_dir, the outputs are streamed to files in out_dir instead (see download), kv_job.paths has them and
+        kv_job.output stays None; the job is only waited for by status, and is not added to the store.
+        """
+        start = perf_counter()
+        if self._lookup(kv_job):
+            if out_dir != None:
+                self._save(kv_job, out_dir, base_name)
             print("OK")
+            return
+        if self._submit(kv_job):
+            reply = None
+            while self._long_poll:
+                reply = self._wait(kv_job, output=out_dir == None)
+                if reply == None or reply['status'] in self.terminal_status:
+                    break
+            if reply == None or reply['status'] not in self.terminal_status:
+                reply = self._poll(kv_job)
+            if reply['status'] == 'completed':
+                if out_dir != None:
+                    self._save(kv_job, out_dir, base_name, reply)
+                else:
+                    kv_job.output = reply if reply.get('output') != None else self._get_job(kv_job)
+            self._record_server(kv_job, reply)
+            self._record(kv_job, 'total', perf_counter() - start)
+            if kv_job.output != None:
+                self._remember(kv_job)
+                print("OK")
+            elif kv_job.paths != None:
+                print("OK")
+            else:
+                print(reply)
+
+    def _save(self, kv_job: KVJob, directory: str, base_name: str, reply: Optional[Dict[str, Any]]=None) -> None:
+        """ Write the outputs of a completed job to directory, setting kv_job.paths and dropping kv_job.output """
+        # outputs already in memory (from the store, or a server that sent them anyway) are written as they are
+        source = kv_job.output if kv_job.output != None else reply
+        if source != None and source.get('output') != None:
+            os.makedirs(directory, exist_ok=True)
+            kv_job.paths = _write_output(source['output'], directory, base_name)
+        else:
+            kv_job.paths = self.download(kv_job, directory, base_name)
+        kv_job.output = None
+
+    def _poll(self, kv_job: KVJob) -> Dict[str, Any]:
+        """ Check the job status on its poll schedule until it finishes """
+        schedule = self.poll_schedule(kv_job)
+        sleep(schedule.first())
+        while True:
+            reply = self._get_statuses([kv_job.id]).get(kv_job.id)
+            status = reply['status'] if reply != None else None
+            if status in self.terminal_status:
+                return reply
+            print(reply)
+            sleep(schedule.next(status))
+
+    def _wait(self, kv_job: KVJob, output: bool=True) -> Optional[Dict[str, Any]]:
+        """ Job reply as soon as it finishes or after wait_timeout, None if the server cannot long-poll
+
+        output=False asks for the status record only, for outputs that are downloaded afterwards.
+        """
+        timeout = (self.timeout[0], self.timeout[1] + self.wait_timeout)
+        params = {'timeout': self.wait_timeout}
+        if not output:
+            params['output'] = 'false'
+        r, download = self._timed_get(f'{self.server}/{kv_job.id}/wait', params=params, timeout=timeout)
+        if r.ok:
+            return self._timed_json(kv_job, r, download)
+        if r.status_code == 404:
+            # older server without /{id}/wait
+            self._long_poll = False
+        # 429: the server holds as many waits as it allows, this job is polled instead
+        return None
+
+    def _lookup(self, kv_job: KVJob) -> bool:
+        """ Fill the job from the local store when its tag was already computed """
+        if self.store == None:
+            return False
+        tag = kv_job.tag
+        reply = self.store.get(tag)
+        if reply == None:
+            return False
+        kv_job.id = tag
+        kv_job.output = reply
+        return True
+
+    def _remember(self, kv_job: KVJob) -> None:
+        if self.store != None:
+            # the server id is the same tag, computed here again in case they ever differ
+            self.store.put(kv_job.tag, kv_job.output)
+
+    def _record(self, kv_job: KVJob, phase: str, seconds: float) -> None:
+        kv_job.latencies[phase] = seconds
+        for hook in self.hooks:
+            hook(kv_job, phase, seconds)
+
+    def _record_server(self, kv_job: KVJob, reply: Dict[str, Any]) -> None:
+        # queue and run come from the ocypod timestamps, not from the client clock
+        for phase, seconds in _server_latencies(reply).items():
+            self._record(kv_job, phase, seconds)
+
+    def _timed_get(self, url: str, **kwargs) -> Tuple[requests.Response, float]:
+        """ GET and the seconds spent reading its body, after the headers arrived (r.elapsed) """
+        start = perf_counter()
+        r = self.session.get(url, **kwargs)
+        return r, max(0.0, perf_counter() - start - r.elapsed.total_seconds())
+
+    def _timed_json(self, kv_job: KVJob, r: requests.Response, download: float) -> Dict[str, Any]:
+        """ Decoded reply, recording download and decode when it carries the job output """
+        start = perf_counter()
+        reply = r.json()
+        if reply.get('output') != None:
+            self._record(kv_job, 'download', download)
+            self._record(kv_job, 'decode', perf_counter() - start)
+        return reply
+
+    def poll_schedule(self, kv_job: KVJob) -> PollSchedule:
+        probe_out = kv_job.input["settings"]["probes"]["probe_out"]
+        return PollSchedule(expected_runtime=predict_runtime(kv_job.n_atoms, probe_out))
 
     def _submit(self, kv_job) -> bool:
-        r = requests.post(self.server + '/create', json=kv_job.input)
+        # settings the server would reject are not uploaded
+        try:
+            kv_job.check()
+        except ValueError as e:
+            print("Debug:", e)
+            return False
+        start = perf_counter()
+        payload = kv_job.payload()
+        data, headers = self._encode(payload)
+        self._record(kv_job, 'serialize', perf_counter() - start)
+        start = perf_counter()
+        # a structure compressing well may fit payload_limit and still be refused once decoded
+        if (len(data) > self.payload_limit or len(payload) > self.json_limit) and self._chunked_upload:
+            reference = self._upload(kv_job)
+            if reference != None:
+                data, headers = self._encode(reference)
+        r = self.session.post(self.server + '/create', data=data, headers=headers, timeout=self.timeout)
+        self._record(kv_job, 'upload', perf_counter() - start)
         if r.ok:
             kv_job.id = r.json()['id']
             return True
@@ -97,29 +507,435 @@ class KVClient:
             print(r.text)
             return False
 
+    def _encode(self, payload: bytes) -> Tuple[bytes, Dict[str, str]]:
+        headers = {'Content-Type': 'application/json'}
+        if self.compress:
+            payload = _gzip(payload)
+            headers['Content-Encoding'] = 'gzip'
+        return payload, headers
+
+    def _upload(self, kv_job: KVJob) -> Optional[bytes]:
+        """ Upload pdb and pdb_ligand as chunks, returning a /create body that references them by hash
+
+        Only the chunks the server does not have yet are sent, so an interrupted upload resumes where it stopped.
+        None when the server has no chunked upload or a chunk could not be sent.
+        """
+        chunks: Dict[str, bytes] = {}
+        # settings as server_json writes them, so the tag matches a direct upload
+        body = json.loads(server_json(dict(kv_job.input, pdb=[], pdb_ligand=None)))
+        for key in ('pdb', 'pdb_ligand'):
+            if kv_job.input.get(key) == None:
+                continue
+            text = ''.join(kv_job.input[key]).encode()
+            parts = [text[i:i + self.upload_chunk] for i in range(0, len(text), self.upload_chunk)]
+            hashes = [str(city_hash64(part)) for part in parts]
+            chunks.update(zip(hashes, parts))
+            # the server fills pdb and pdb_ligand back from the chunks before tagging the job
+            body[key] = [] if key == 'pdb' else None
+            body[key + '_chunks'] = hashes
+        r = self.session.post(self.server + '/upload/missing', json={'hashes': list(chunks)}, timeout=self.timeout)
+        if r.status_code in (404, 405):
+            # older server, the job is sent whole and may be refused
+            self._chunked_upload = False
+            return None
+        if not r.ok:
+            return None
+        missing = r.json()['missing']
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            uploaded = list(executor.map(lambda h: self._upload_chunk(h, chunks[h]), missing))
+        if not all(uploaded):
+            return None
+        return json.dumps(body).encode()
+
+    def _upload_chunk(self, chunk_hash: str, chunk: bytes) -> bool:
+        headers = {'Content-Type': 'application/octet-stream'}
+        r = self.session.put(f'{self.server}/upload/{chunk_hash}', data=chunk, headers=headers, timeout=self.timeout)
+        if not r.ok:
+            print("Debug:", r)
+            print(r.text)
+        return r.ok
+
     def _get_results(self, kv_job) -> Optional[Dict[str, Any]]:
-        r = requests.get(self.server + '/' + kv_job.id)
-        if r.ok:
-            results = r.json()
+        results = self._get_job(kv_job)
+        if results != None:
             if results['status'] == 'completed':
                 return results
             else:
                 print(results)
-                return None
+        return None
+
+    def download(self, kv_job: KVJob, directory: str, base_name: str='job') -> Optional[Dict[str, str]]:
+        """ Write pdb_kv, report and log of a completed job to `directory`, chunk by chunk
+
+        Files are named as performance.Job.export names them. Returns the written paths by output name,
+        or None while the job has no output. Servers without /{id}/output/{name} are read through /{id}, as are
+        Compact jobs (their pdb_kv is rebuilt from pdb_kv_compact).
+        """
+        start = perf_counter()
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        for name, fn in self.output_files.items():
+            path = os.path.join(directory, fn.format(base_name))
+            url = f'{self.server}/{kv_job.id}/output/{name}'
+            with self.session.get(url, timeout=self.timeout, stream=True) as r:
+                if r.status_code == 404 and not paths:
+                    return self._download_job(kv_job, directory, base_name)
+                if not r.ok:
+                    return None
+                _write_chunks(r.iter_content(self.chunk_size), path)
+            paths[name] = path
+        self._record(kv_job, 'download', perf_counter() - start)
+        return paths
+
+    def _download_job(self, kv_job: KVJob, directory: str, base_name: str) -> Optional[Dict[str, str]]:
+        job = self._get_job(kv_job)
+        if job == None or job.get('output') == None:
+            return None
+        return _write_output(job['output'], directory, base_name)
+
+    def _get_job(self, kv_job) -> Optional[Dict[str, Any]]:
+        r, download = self._timed_get(self.server + '/' + kv_job.id, timeout=self.timeout)
+        if r.ok:
+            return self._timed_json(kv_job, r, download)
         else:
             # print(r)
             return None
-    
+
+    def _get_statuses(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """ Status records (without output) of several jobs, one request per status_batch ids """
+        statuses = {}
+        for i in range(0, len(ids), self.status_batch):
+            chunk = ids[i:i + self.status_batch]
+            if self._bulk_status:
+                r = self.session.post(self.server + '/status', json={'ids': chunk}, timeout=self.timeout)
+                if r.ok:
+                    statuses.update((s['id'], s) for s in r.json())
+                    continue
+                if r.status_code not in (404, 405):
+                    continue
+                # older server without /status, ask each job instead
+                self._bulk_status = False
+            for job_id in chunk:
+                r = self.session.get(self.server + '/' + job_id, timeout=self.timeout)
+                if r.ok:
+                    statuses[job_id] = r.json()
+                elif r.status_code == 404:
+                    statuses[job_id] = {'id': job_id, 'status': 'not_found'}
+        return statuses
+
+
+class AsyncKVClient(KVClient):
+    """ KVClient that keeps several jobs submitted and polled at once """
+
+    def __init__(self, server: str, port="80", **kwargs):
+        # pool_size should be at least the concurrency given to run_many
+        super().__init__(server, port, **kwargs)
+
+    async def run_many(self, kv_jobs: Iterable[KVJob], concurrency: int=8, download: Optional[Callable[[KVJob], Tuple[str, str]]]=None) -> AsyncIterator[KVJob]:
+        """ Run jobs with at most `concurrency` in flight, yielding each one when it finishes
+
+        Submissions run concurrently. Jobs are then long-polled with GET /{id}/wait when the server offers it,
+        otherwise all jobs due for a status check are asked in one POST /status. A job hitting one of JOB_ERRORS is
+        yielded without output, the others go on.
+
+        download: (directory, base name) for a job; its outputs are then streamed there as in KVClient.run(out_dir)
+        instead of kept in kv_job.output, so memory stays bounded by the jobs in flight.
+        """
+        loop = asyncio.get_event_loop()
+        # one thread per job in flight plus one for status requests
+        executor = ThreadPoolExecutor(max_workers=concurrency + 1)
+        kv_jobs = iter(kv_jobs)
+        # submissions and long polls, each one resolving to (kv_job, start, state)
+        tasks = set()
+        # jobs checked through /status: [kv_job, schedule, time of next check, start]
+        waiting: List[List[Any]] = []
+        try:
+            while True:
+                # refill the window with new jobs
+                while len(tasks) + len(waiting) < concurrency:
+                    kv_job = next(kv_jobs, None)
+                    if kv_job == None:
+                        break
+                    tasks.add(asyncio.ensure_future(self._start(kv_job, loop, executor, download)))
+                if not tasks and not waiting:
+                    break
+
+                # wait for a submission, a long poll or for the next job due to be checked
+                timeout = max(0.0, min(w[2] for w in waiting) - monotonic()) if waiting else None
+                if tasks:
+                    done, tasks = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        kv_job, start, state = task.result()
+                        if state == 'finished':
+                            yield kv_job
+                        elif state == 'submitted' and self._long_poll:
+                            tasks.add(asyncio.ensure_future(self._long_wait(kv_job, start, loop, executor, download)))
+                        else:
+                            schedule = self.poll_schedule(kv_job)
+                            waiting.append([kv_job, schedule, monotonic() + schedule.first(), start])
+                else:
+                    await asyncio.sleep(timeout)
+
+                # one status request for every due job
+                now = monotonic()
+                due = [w for w in waiting if w[2] <= now]
+                if not due:
+                    continue
+                try:
+                    statuses = await loop.run_in_executor(executor, self._get_statuses, list({w[0].id for w in due}))
+                except JOB_ERRORS as e:
+                    for w in due:
+                        yield self._error(w[0], w[3], e)
+                    waiting = [w for w in waiting if w[2] > now]
+                    continue
+                finished = []
+                for w in due:
+                    reply = statuses.get(w[0].id)
+                    status = reply['status'] if reply != None else None
+                    if status in self.terminal_status:
+                        finished.append((w, reply))
+                    else:
+                        w[2] = monotonic() + w[1].next(status)
+                for kv_job in await asyncio.gather(*(self._finish(w[0], w[3], reply, loop, executor, download) for w, reply in finished)):
+                    yield kv_job
+                finished_ids = {id(w) for w, _ in finished}
+                waiting = [w for w in waiting if id(w) not in finished_ids]
+        finally:
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False)
+
+    async def sweep(self, path_protein_pdb: str, path_ligand_pdb: Optional[str]=None, concurrency: int=8, **grid) -> 'pandas.DataFrame':
+        """ Run KVJob.sweep concurrently and tabulate volume and area of every cavity per parameter point """
+        kv_jobs = KVJob.sweep(path_protein_pdb, path_ligand_pdb, **grid)
+        async for _ in self.run_many(kv_jobs, concurrency=concurrency):
+            pass
+        return sweep_table(kv_jobs)
+
+    async def _start(self, kv_job: KVJob, loop, executor, download=None) -> Tuple[KVJob, float, str]:
+        start = perf_counter()
+        try:
+            if await loop.run_in_executor(executor, self._lookup, kv_job):
+                if download != None:
+                    await loop.run_in_executor(executor, self._save, kv_job, *download(kv_job))
+                return kv_job, start, 'finished'
+            submitted = await loop.run_in_executor(executor, self._submit, kv_job)
+        except JOB_ERRORS as e:
+            return self._error(kv_job, start, e), start, 'finished'
+        self._record(kv_job, 'submit', perf_counter() - start)
+        return kv_job, start, 'submitted' if submitted else 'finished'
+
+    async def _long_wait(self, kv_job: KVJob, start: float, loop, executor, download=None) -> Tuple[KVJob, float, str]:
+        while True:
+            try:
+                reply = await loop.run_in_executor(executor, self._wait, kv_job, download == None)
+            except JOB_ERRORS as e:
+                return self._error(kv_job, start, e), start, 'finished'
+            if reply == None:
+                # long poll failed, the job is checked through /status from now on
+                return kv_job, start, 'polled'
+            if reply['status'] in self.terminal_status:
+                return await self._finish(kv_job, start, reply, loop, executor, download), start, 'finished'
+
+    async def _finish(self, kv_job: KVJob, start: float, reply: Dict[str, Any], loop, executor, download=None) -> KVJob:
+        try:
+            if reply['status'] == 'completed' and download != None:
+                await loop.run_in_executor(executor, self._save, kv_job, *download(kv_job), reply)
+            elif reply.get('output') != None:
+                kv_job.output = reply
+            elif reply['status'] == 'completed':
+                kv_job.output = await loop.run_in_executor(executor, self._get_job, kv_job)
+            self._record_server(kv_job, reply)
+        except JOB_ERRORS as e:
+            kv_job.output = None
+            return self._error(kv_job, start, e)
+        if kv_job.output != None:
+            try:
+                await loop.run_in_executor(executor, self._remember, kv_job)
+            except OSError as e:
+                # the result is still returned, only not cached
+                print("Debug:", kv_job.id, repr(e))
+        self._record(kv_job, 'total', perf_counter() - start)
+        return kv_job
+
+    def _error(self, kv_job: KVJob, start: float, e: Exception) -> KVJob:
+        """ Job finished without output after one of JOB_ERRORS """
+        print("Debug:", kv_job.id, repr(e))
+        self._record(kv_job, 'total', perf_counter() - start)
+        return kv_job
+
+
+def sweep_table(kv_jobs: Iterable[KVJob]) -> 'pandas.DataFrame':
+    """ One row per cavity and job (swept parameters, id, cavity, volume, area), a row without cavity for failed jobs """
+    import pandas as pd
+
+    rows = []
+    for kv_job in kv_jobs:
+        row = dict(kv_job.parameters, id=kv_job.id)
+        if kv_job.output == None:
+            rows.append(dict(row, cavity=None, volume=float('nan'), area=float('nan')))
+            continue
+        results = kv_job.parsed_report['RESULTS']
+        volume, area = results.get('VOLUME', {}), results.get('AREA', {})
+        for cavity in volume:
+            rows.append(dict(row, cavity=cavity, volume=volume[cavity], area=area.get(cavity, float('nan'))))
+    return pd.DataFrame(rows)
+
+
+def write_timings(kv_jobs: Iterable[KVJob], fn: str) -> None:
+    """ Append one JSON line per job to `fn`: id, swept parameters, completed and its timed phases (s) """
+    with open(fn, 'a') as f:
+        for kv_job in kv_jobs:
+            record = {'id': kv_job.id, 'parameters': kv_job.parameters, 'completed': kv_job.output != None}
+            record.update(kv_job.latencies)
+            f.write(json.dumps(record) + '\n')
+
+
+def _gzip(data: bytes, level: int=6) -> bytes:
+    # wbits=31 writes a gzip header and trailer instead of a zlib one
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _write_output(output: Dict[str, str], directory: str, base_name: str) -> Dict[str, str]:
+    paths = {}
+    for name, fn in KVClient.output_files.items():
+        paths[name] = os.path.join(directory, fn.format(base_name))
+        text = pdb_kv_text(output) if name == 'pdb_kv' else output[name]
+        _write_chunks([text.encode()], paths[name])
+    return paths
+
+
+def _write_chunks(chunks: Iterable[bytes], path: str) -> None:
+    # write then rename, so an interrupted download never leaves a truncated file
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp, path)
+
+
+def _parse_time(timestamp: str) -> datetime:
+    # ocypod timestamps are RFC 3339, fromisoformat needs an explicit offset and at most 6 fractional digits
+    timestamp = timestamp.replace('Z', '+00:00')
+    if '.' in timestamp:
+        head, tail = timestamp.split('.', 1)
+        digits = len(tail) - len(tail.lstrip('0123456789'))
+        timestamp = head + '.' + tail[:min(digits, 6)].ljust(6, '0') + tail[digits:]
+    return datetime.fromisoformat(timestamp)
+
+
+def _server_latencies(reply: Dict[str, Any]) -> Dict[str, float]:
+    """ Queue and run latencies (s) from the job timestamps kept by ocypod """
+    latencies = {}
+    created_at, started_at, ended_at = reply.get('created_at'), reply.get('started_at'), reply.get('ended_at')
+    if created_at != None and started_at != None:
+        latencies['queue'] = (_parse_time(started_at) - _parse_time(created_at)).total_seconds()
+    if started_at != None and ended_at != None:
+        latencies['run'] = (_parse_time(ended_at) - _parse_time(started_at)).total_seconds()
+    return latencies
+
+
+def submit(source: str, out: str, server: str="http://localhost", port: str="8081", concurrency: int=8, **settings) -> Dict[str, int]:
+    """ Run every structure of a directory or zip archive, writing results laid out as performance.Job.export does
+
+    out/<id>/ gets <name>.KVFinder.output.pdb, <name>.KVFinder.results.toml, KVFinder.log and <name>_parameters.toml,
+    the outputs streamed to disk as they are downloaded.
+    Each finished structure is appended to out/jobs.jsonl (name, id, status and phase times); structures completed
+    there are skipped, so an interrupted run resumes where it stopped. Returns the number of jobs per status.
+    """
+    os.makedirs(out, exist_ok=True)
+    manifest_fn = os.path.join(out, 'jobs.jsonl')
+    done = set()
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['status'] == 'completed':
+                    done.add(record['name'])
+
+    names: Dict[int, str] = {}
+
+    def jobs() -> Iterator[KVJob]:
+        # structures are read one at a time, as run_many asks for them
+        for name, f in iter_structures(source):
+            if name in done:
+                continue
+            kv_job = KVJob(f).configure(**settings)
+            names[id(kv_job)] = name
+            yield kv_job
+
+    def target(kv_job: KVJob) -> Tuple[str, str]:
+        return os.path.join(out, kv_job.id), _base_name(names[id(kv_job)])
+
+    async def run() -> Dict[str, int]:
+        counts = {'completed': 0, 'failed': 0, 'skipped': len(done)}
+        client = AsyncKVClient(server, port, pool_size=concurrency + 1)
+        with client, open(manifest_fn, 'a') as manifest:
+            async for kv_job in client.run_many(jobs(), concurrency=concurrency, download=target):
+                name = names.pop(id(kv_job))
+                status = 'completed' if kv_job.paths != None else 'failed'
+                if kv_job.paths != None:
+                    try:
+                        _export(kv_job, name, os.path.join(out, kv_job.id))
+                    except OSError as e:
+                        # disk full, permissions...: this structure is retried on the next run, the others go on
+                        print("Debug:", name, e)
+                        status = 'failed'
+                manifest.write(json.dumps(dict(name=name, id=kv_job.id, status=status, **kv_job.latencies)) + '\n')
+                manifest.flush()
+                counts[status] += 1
+        return counts
+
+    return asyncio.run(run())
+
+
+def _base_name(name: str) -> str:
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def _export(kv_job: KVJob, name: str, directory: str) -> None:
+    """ Write the parameters file next to the outputs streamed by run_many """
+    import toml
+
+    base_name = _base_name(name)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f'{base_name}_parameters.toml'), 'w') as f:
+        f.write("# TOML configuration file for KVFinder-web job.\n\n")
+        f.write("title = \"KVFinder-web parameters file\"\n\n")
+        toml.dump({'files': {'pdb': name, 'ligand': '-'}, 'settings': kv_job.input['settings']}, f)
+
+
+def _setting(text: str) -> Tuple[str, Any]:
+    # NAME=VALUE, the value read as JSON (numbers, true/false) or else kept as a string
+    name, _, value = text.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def main(argv: Optional[List[str]]=None) -> None:
+    parser = argparse.ArgumentParser(prog='kvfinder-ws', description='KVFinder-web batch client')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_submit = commands.add_parser('submit', help='run every structure of a directory or zip archive')
+    parser_submit.add_argument('source', help='directory or zip archive of PDB files')
+    parser_submit.add_argument('--out', default='results', help='results directory (default: results)')
+    parser_submit.add_argument('--concurrency', type=int, default=8, help='jobs in flight (default: 8)')
+    parser_submit.add_argument('--server', default='http://localhost', help='server url (default: http://localhost)')
+    parser_submit.add_argument('--port', default='8081', help='server port (default: 8081)')
+    parser_submit.add_argument('--set', type=_setting, action='append', default=[], metavar='NAME=VALUE', help='job setting, e.g. --set probe_out=6.0 (repeatable)')
+    args = parser.parse_args(argv)
+
+    counts = submit(args.source, args.out, args.server, args.port, args.concurrency, **dict(args.set))
+    print(', '.join(f'{n} {status}' for status, n in counts.items()))
+
 
 if __name__ == "__main__":
-    # create and configure a KVClient with server url and port (default 80)
-    # local server 
-    kv = KVClient("http://localhost", "8081")
-    # remote server
-    # kv = KVClient("http://parkvfinder")
-    # create a job using a pdb file with default configuration (code to configure is not implemented)
-    job = KVJob("kv1000/4GOU_A.pdb")
-    # send job to server and wait until completion
-    kv.run(job)
-    # print job results
-    print(json.dumps(job.output, indent=2))
+    # kvfinder-ws submit kv1000.zip --concurrency 8 --out results
+    main()
+    # a single job, from python:
+    # kv = KVClient("http://localhost", "8081")
+    # job = KVJob("kv1000/4GOU_A.pdb")
+    # kv.run(job)
+    # print(json.dumps(job.output, indent=2))
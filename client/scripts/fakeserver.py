@@ -0,0 +1,358 @@
+import json
+import gzip
+import time
+import random
+import argparse
+import threading
+from queue import Queue
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Any, Callable, Dict, List, Tuple
+from urllib.parse import urlsplit, parse_qs
+from cache import job_tag, city_hash64
+from client import predict_runtime, check_input
+
+
+# reply of kv_server json_error_handler to a body that is not a valid Input
+BAD_INPUT = 'Please update your plugin'
+
+# limits of kv::webserver
+PAYLOAD_LIMIT = 1_000_000
+JSON_LIMIT = 8_000_000
+STATUS_LIMIT = 1000
+WAIT_LIMIT = 30
+CHUNK_LIMIT = 1_000_000
+UPLOAD_LIMIT = 50_000_000
+
+
+def default_service_time(input: Dict[str, Any]) -> float:
+    """ parKVFinder runtime predicted from the structure size and probe out (see client.predict_runtime) """
+    n_atoms = sum(1 for line in input['pdb'] if line.startswith(('ATOM', 'HETATM')))
+    return predict_runtime(n_atoms, input['settings']['probes']['probe_out'])
+
+
+def default_output_size(input: Dict[str, Any]) -> int:
+    """ Cavity points of the synthetic pdb_kv, about one per 10 atoms """
+    return max(1, len(input['pdb']) // 10)
+
+
+class FakeKVServer(object):
+    """ kv_server, ocypod and kv_worker stand-in, in this process, for load tests without Docker
+
+    workers: jobs run at once, as docker-compose --scale kv-worker=N
+    service_time: seconds a job input takes to run (default: default_service_time)
+    output_size: cavity points in the output of a job input (default: default_output_size)
+    speedup: service times are divided by this factor
+    failure_rate: fraction of jobs ending as failed
+    job_timeout: jobs running longer end as timed_out (ocypod queue timeout, 30 minutes in kv_server)
+
+    Jobs are tagged as kv::webserver::create tags them, so the same input gives the same id and an existing job is
+    returned instead of a new one. Serves /create, /{id}, /{id}/wait, /{id}/output/{name}, /status and /upload.
+    """
+
+    def __init__(self, port: int=0, workers: int=1, service_time: Callable[[Dict[str, Any]], float]=default_service_time, output_size: Callable[[Dict[str, Any]], int]=default_output_size, speedup: float=1.0, failure_rate: float=0.0, job_timeout: float=1800.0, seed: Optional[int]=None):
+        self.service_time = service_time
+        self.output_size = output_size
+        self.speedup = speedup
+        self.failure_rate = failure_rate
+        self.job_timeout = job_timeout
+        self.random = random.Random(seed)
+        # tag -> job record as GET /{id} returns it
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.chunks: Dict[str, bytes] = {}
+        # requests served per endpoint
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._queue: 'Queue[Optional[Tuple[str, Dict[str, Any]]]]' = Queue()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), _handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self) -> 'FakeKVServer':
+        for worker in self._workers:
+            worker.start()
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        for _ in self._workers:
+            self._queue.put(None)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def create(self, input: Dict[str, Any]) -> Tuple[int, Any]:
+        tag = job_tag(input)
+        with self._lock:
+            if tag in self.jobs:
+                # a copy, the workers update the job after the lock is released
+                return 200, dict(self.jobs[tag])
+            self.jobs[tag] = {
+                'id': tag,
+                'status': 'queued',
+                'output': None,
+                'created_at': _now(),
+                'started_at': None,
+                'ended_at': None,
+                'expires_after': '1d',
+            }
+        self._queue.put((tag, input))
+        return 200, {'id': tag}
+
+    def job(self, tag: str, output: bool=True) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self.jobs.get(tag)
+            if job == None:
+                return None
+            return dict(job) if output else {key: value for key, value in job.items() if key != 'output'}
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item == None:
+                return
+            tag, input = item
+            with self._lock:
+                self.jobs[tag].update(status='running', started_at=_now())
+            seconds = self.service_time(input) / self.speedup
+            time.sleep(min(seconds, self.job_timeout))
+            if seconds > self.job_timeout:
+                update = {'status': 'timed_out'}
+            elif self.random.random() < self.failure_rate:
+                update = {'status': 'failed'}
+            else:
+                update = {'status': 'completed', 'output': synthetic_output(self.output_size(input), self.random)}
+            with self._lock:
+                self.jobs[tag].update(update, ended_at=_now())
+
+    def _count(self, endpoint: str) -> None:
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+
+def _strings(data: bytes, key: str) -> Optional[List[str]]:
+    # list of strings under key of a JSON body, None where the server's Json extractor would answer 400
+    try:
+        values = json.loads(data)[key]
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        return None
+    return values
+
+
+def synthetic_output(n_points: int, rng: random.Random) -> Dict[str, str]:
+    """ pdb_kv, report and log shaped as parKVFinder writes them, with n_points cavity points """
+    n_cavities = max(1, min(26 * 26, n_points // 50))
+    names = [f'K{chr(65 + i // 26)}{chr(65 + i % 26)}' for i in range(n_cavities)]
+    lines = []
+    counts = {name: 0 for name in names}
+    for i in range(n_points):
+        cavity = names[i * n_cavities // n_points]
+        counts[cavity] += 1
+        atom = 'HS' if rng.random() < 0.3 else 'H'
+        x, y, z = (rng.uniform(-50.0, 50.0) for _ in range(3))
+        lines.append(f'ATOM  {i % 100000:5d}  {atom:<3} {cavity}   259    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00\n')
+    report = ['# TOML results file for parKVFinder software\n', '\n[FILES_PATH]\n', 'INPUT = "./protein.pdb"\n', 'LIGAND = "-"\n', 'OUTPUT = "./KVFinderWeb.KVFinder.output.pdb"\n']
+    report.append('\n[PARAMETERS]\nRESOLUTION = "Low"\n\n[RESULTS]\n\n[RESULTS.VOLUME]\n')
+    report += [f'{name} = {count * 0.216:.2f}\n' for name, count in counts.items()]
+    report.append('\n[RESULTS.AREA]\n')
+    report += [f'{name} = {count * 0.36:.2f}\n' for name, count in counts.items()]
+    report.append('\n[RESULTS.RESIDUES]\n')
+    report += [f'{name} = [ [ "{10 + k}", "A", "ALA",], ]\n' for k, name in enumerate(names)]
+    log = f'Running parKVFinder for: ./protein.pdb\nDictionary: ./dictionary\nCavities found: {n_cavities}\n'
+    return {'pdb_kv': ''.join(lines), 'report': ''.join(report), 'log': log}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _handler(server: FakeKVServer):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, code: int, body: Any=None, content_type: str='application/json') -> None:
+            if body == None:
+                data = b''
+            elif isinstance(body, str):
+                data = body.encode()
+            else:
+                data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self, limit: int, length_only: bool=False) -> Optional[bytes]:
+            # None when the request was already answered (411, 413)
+            if self.headers.get('Content-Length') != None:
+                size = int(self.headers['Content-Length'])
+                data = self.rfile.read(size)
+            elif self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                data = self._read_chunked()
+                # length_only: limit applies to a declared length (as on /create), JSON_LIMIT still bounds the body
+                size = 0 if length_only else len(data)
+            else:
+                self._send(411)
+                return None
+            if size > limit:
+                self._send(413)
+                return None
+            if self.headers.get('Content-Encoding') == 'gzip':
+                try:
+                    data = gzip.decompress(data)
+                except (OSError, EOFError):
+                    self._send(400, BAD_INPUT, 'text/plain')
+                    return None
+            if len(data) > JSON_LIMIT:
+                self._send(413)
+                return None
+            return data
+
+        def _read_chunked(self) -> bytes:
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    # skip trailers, up to the empty line ending the body
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            parts = url.path.strip('/').split('/')
+            if parts == ['']:
+                server._count('hello')
+                return self._send(200, 'KVFinder Web', 'text/plain')
+            if len(parts) == 1:
+                server._count('ask')
+                job = server.job(parts[0])
+                return self._send(200, job) if job != None else self._send(404)
+            if len(parts) == 2 and parts[1] == 'wait':
+                server._count('wait')
+                query = parse_qs(url.query)
+                timeout = min(int(query.get('timeout', [WAIT_LIMIT])[0]), WAIT_LIMIT)
+                output = query.get('output', ['true'])[0] != 'false'
+                deadline = time.monotonic() + timeout
+                while True:
+                    job = server.job(parts[0], output=output)
+                    if job == None:
+                        return self._send(200, {'id': parts[0], 'status': 'not_found'})
+                    if job['status'] in ('completed', 'failed', 'timed_out', 'cancelled') or time.monotonic() >= deadline:
+                        return self._send(200, job)
+                    time.sleep(0.05)
+            if len(parts) == 3 and parts[1] == 'output':
+                server._count('output')
+                job = server.job(parts[0])
+                if job == None or job['output'] == None or parts[2] not in job['output']:
+                    return self._send(404)
+                return self._send(200, job['output'][parts[2]], 'text/plain; charset=utf-8')
+            self._send(404)
+
+        def do_POST(self):
+            path = urlsplit(self.path).path
+            if path == '/create':
+                server._count('create')
+                data = self._body(PAYLOAD_LIMIT, length_only=True)
+                if data == None:
+                    return
+                # answered as kv::webserver::create does, so error paths can be load tested too
+                try:
+                    input = json.loads(data)
+                    for key in ('pdb', 'pdb_ligand'):
+                        hashes = input.pop(key + '_chunks', None)
+                        if hashes != None:
+                            missing = [h for h in hashes if h not in server.chunks]
+                            if missing:
+                                return self._send(400, {'missing': missing})
+                            input[key] = b''.join(server.chunks[h] for h in hashes).decode().splitlines(keepends=True)
+                    # pdb and pdb_ligand share UPLOAD_LIMIT
+                    if sum(len(line) for key in ('pdb', 'pdb_ligand') for line in input.get(key) or ()) > UPLOAD_LIMIT:
+                        return self._send(413)
+                    if not isinstance(input.get('pdb'), list):
+                        raise KeyError('pdb')
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    return self._send(400, BAD_INPUT, 'text/plain')
+                try:
+                    check_input(input)
+                except ValueError as e:
+                    # the server replies the {:?} of its message, quoted
+                    return self._send(400, json.dumps(str(e)), 'text/plain')
+                except (KeyError, TypeError):
+                    return self._send(400, BAD_INPUT, 'text/plain')
+                return self._send(*server.create(input))
+            if path == '/status':
+                server._count('status')
+                data = self._body(JSON_LIMIT)
+                if data == None:
+                    return
+                ids = _strings(data, 'ids')
+                if ids == None:
+                    return self._send(400, BAD_INPUT, 'text/plain')
+                if len(ids) > STATUS_LIMIT:
+                    return self._send(400, f'At most {STATUS_LIMIT} ids per request', 'text/plain')
+                return self._send(200, [server.job(i, output=False) or {'id': i, 'status': 'not_found'} for i in ids])
+            if path == '/upload/missing':
+                server._count('missing')
+                data = self._body(JSON_LIMIT)
+                if data == None:
+                    return
+                hashes = _strings(data, 'hashes')
+                if hashes == None:
+                    return self._send(400, BAD_INPUT, 'text/plain')
+                return self._send(200, {'missing': [h for h in hashes if h not in server.chunks]})
+            self._send(404)
+
+        def do_PUT(self):
+            parts = urlsplit(self.path).path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'upload':
+                return self._send(404)
+            server._count('upload')
+            data = self._body(CHUNK_LIMIT)
+            if data == None:
+                return
+            if str(city_hash64(data)) != parts[1]:
+                return self._send(400, 'Chunk does not match its hash', 'text/plain')
+            server.chunks[parts[1]] = data
+            self._send(200, {'hash': parts[1]})
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='KVFinder-web server stand-in for load tests')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--speedup', type=float, default=1.0, help='divide the predicted service times by this factor')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeKVServer(args.port, args.workers, speedup=args.speedup, failure_rate=args.failure_rate).start()
+    print(f'Fake KVFinder-web server at {server.url} with {args.workers} worker(s)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,169 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, Any, Callable, Dict, Iterable, AsyncIterator
+from time import perf_counter
+from client import KVJob, sweep_table, _server_latencies
+from cache import ResultStore
+from results import encode_compact, parse_pdb_kv
+
+
+# files parKVFinder writes for base_name KVFinderWeb, as read by kv::worker::JobInput::run
+OUTPUT_FILES = {
+    'pdb_kv': os.path.join('KV_Files', 'KVFinderWeb', 'KVFinderWeb.KVFinder.output.pdb'),
+    'report': os.path.join('KV_Files', 'KVFinderWeb', 'KVFinderWeb.KVFinder.results.toml'),
+    'log': os.path.join('KV_Files', 'KVFinder.log'),
+}
+
+
+class LocalKVClient:
+    """ KVClient that runs parKVFinder on this machine instead of sending jobs to a server
+
+    kv_path: parKVFinder directory, with the executable and its dictionary (default: $KVFinder_PATH)
+    workers: parKVFinder runs at once (default: one per core), the cores are split among them as OpenMP threads
+    scratch: directory for the job files (default: /dev/shm when available, so they stay in memory)
+    keep: keep the job directories after the run
+    """
+
+    def __init__(self, kv_path: Optional[str]=None, workers: Optional[int]=None, scratch: Optional[str]=None, keep: bool=False, store: Optional[ResultStore]=None, hooks: Iterable[Callable[[KVJob, str, float], None]]=()):
+        self.kv_path = kv_path if kv_path != None else os.environ['KVFinder_PATH']
+        self.workers = workers if workers != None else os.cpu_count()
+        self.threads = max(1, os.cpu_count() // self.workers)
+        if scratch == None:
+            scratch = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.scratch = scratch
+        self.keep = keep
+        self.store = store
+        self.hooks = list(hooks)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, kv_job: KVJob):
+        reply = asyncio.run(self._run(kv_job))
+        print("OK" if kv_job.output != None else reply)
+
+    async def run_many(self, kv_jobs: Iterable[KVJob], concurrency: Optional[int]=None) -> AsyncIterator[KVJob]:
+        """ Run jobs with at most `concurrency` (default: workers) in the pool, yielding each one when it finishes """
+        concurrency = concurrency if concurrency != None else self.workers
+        kv_jobs = iter(kv_jobs)
+        tasks = set()
+        while True:
+            while len(tasks) < concurrency:
+                kv_job = next(kv_jobs, None)
+                if kv_job == None:
+                    break
+                tasks.add(asyncio.ensure_future(self._finished(kv_job)))
+            if not tasks:
+                break
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    async def sweep(self, path_protein_pdb: str, path_ligand_pdb: Optional[str]=None, concurrency: Optional[int]=None, **grid) -> 'pandas.DataFrame':
+        """ Run KVJob.sweep in the pool and tabulate volume and area of every cavity per parameter point """
+        kv_jobs = KVJob.sweep(path_protein_pdb, path_ligand_pdb, **grid)
+        async for _ in self.run_many(kv_jobs, concurrency=concurrency):
+            pass
+        return sweep_table(kv_jobs)
+
+    async def _finished(self, kv_job: KVJob) -> KVJob:
+        await self._run(kv_job)
+        return kv_job
+
+    async def _run(self, kv_job: KVJob) -> Dict[str, Any]:
+        start = perf_counter()
+        kv_job.id = kv_job.tag
+        reply = self.store.get(kv_job.id) if self.store != None else None
+        if reply == None:
+            try:
+                kv_job.check()
+            except ValueError as e:
+                return {'id': kv_job.id, 'status': 'failed', 'error': str(e)}
+            loop = asyncio.get_event_loop()
+            args = (self.kv_path, self.scratch, self.keep, self.threads, kv_job.id, kv_job.input, _now())
+            try:
+                reply = await loop.run_in_executor(self.executor, run_parkvfinder, *args)
+            except (OSError, ValueError, RuntimeError) as e:
+                # missing executable or output files, a broken pool: this job fails, the others of run_many go on
+                return {'id': kv_job.id, 'status': 'failed', 'error': repr(e)}
+            for phase, seconds in _server_latencies(reply).items():
+                self._record(kv_job, phase, seconds)
+            if reply['status'] == 'completed' and self.store != None:
+                self.store.put(kv_job.id, reply)
+        if reply['status'] == 'completed':
+            kv_job.output = reply
+        self._record(kv_job, 'total', perf_counter() - start)
+        return reply
+
+    def _record(self, kv_job: KVJob, phase: str, seconds: float) -> None:
+        kv_job.latencies[phase] = seconds
+        for hook in self.hooks:
+            hook(kv_job, phase, seconds)
+
+
+def run_parkvfinder(kv_path: str, scratch: str, keep: bool, threads: int, job_id: str, input: Dict[str, Any], created_at: str) -> Dict[str, Any]:
+    """ Run one job input as kv::worker does, returning a reply shaped like GET /{id}
+
+    Runs in the pool processes; the queue time of the reply is the time spent waiting for a free process.
+    """
+    import toml
+
+    job_dn = tempfile.mkdtemp(prefix=f'kv-{job_id}-', dir=scratch)
+    try:
+        params = {
+            'title': 'KVFinder-worker parameters',
+            'files_path': {
+                'dictionary': os.path.join(kv_path, 'dictionary'),
+                'pdb': './protein.pdb',
+                'output': './',
+                'base_name': 'KVFinderWeb',
+                'ligand': './ligand.pdb',
+            },
+            'settings': input['settings'],
+        }
+        with open(os.path.join(job_dn, 'params.toml'), 'w') as f:
+            toml.dump(params, f)
+        with open(os.path.join(job_dn, 'protein.pdb'), 'w') as f:
+            f.write(''.join(input['pdb']) + '\n')
+        if input.get('pdb_ligand') != None:
+            with open(os.path.join(job_dn, 'ligand.pdb'), 'w') as f:
+                f.write(''.join(input['pdb_ligand']) + '\n')
+
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+        started_at = _now()
+        process = subprocess.run([os.path.join(kv_path, 'parKVFinder'), '-p', 'params.toml'], cwd=job_dn, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        ended_at = _now()
+        reply = {'id': job_id, 'created_at': created_at, 'started_at': started_at, 'ended_at': ended_at, 'expires_after': None}
+        if process.returncode != 0:
+            return dict(reply, status='failed', output=None, error=process.stdout.decode(errors='replace'))
+        output = {}
+        for name, fn in OUTPUT_FILES.items():
+            with open(os.path.join(job_dn, fn)) as f:
+                output[name] = f.read()
+        if input.get('output_format') == 'Compact':
+            # as kv::worker: the text is dropped when the compact form could be built (Low resolution grid)
+            try:
+                output['pdb_kv_compact'] = encode_compact(parse_pdb_kv(output['pdb_kv']), 0.6)
+                output['pdb_kv'] = ''
+            except ValueError:
+                pass
+        return dict(reply, status='completed', output=output)
+    finally:
+        if not keep:
+            shutil.rmtree(job_dn, ignore_errors=True)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
@@ -1,18 +1,25 @@
-import os, sys, toml, json, zlib, time
+import os, sys, toml, json, zlib, time, random, shutil, sqlite3, subprocess, uuid
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import dateutil.parser
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, Iterable, List, Sequence
 from math import ceil, floor
+from datetime import datetime, timezone
+from client import KVClient, PollSchedule, predict_runtime, _write_chunks
+from cache import server_json
+from structure import load_pdb, structure_statistics
+from results import ParsedOutput, pdb_kv_text
         
 
 class Job(object):
     """ Create KVFinder-web job """
 
-    def __init__(self, pdb: str, ligand_pdb: Optional[str]=None, probe_out: float=4.0, removal_distance: float=2.4):
+    def __init__(self, pdb: str, ligand_pdb: Optional[str]=None, probe_out: float=4.0, removal_distance: float=2.4, read_pdb: bool=True):
         # Job Information (local)
         self.status: Optional[str] = None
         self.pdb: Optional[str] = pdb
@@ -25,12 +32,26 @@ class Job(object):
         self.id: Optional[str] = None
         self.input: Optional[Dict[str, Any]] = {} 
         self.output: Optional[Dict[str, Any]] = None
+        # Bytes of output downloaded by the Retriever
+        self.output_size: Optional[int] = None
         
-        # Fill parameters and inputs
+        # Fill parameters and inputs (read_pdb=False leaves pdb out of input, for jobs that are only retrieved)
         self._default_settings(probe_out, removal_distance)
-        self._add_pdb(pdb)
-        if ligand_pdb != None:
-            self._add_pdb(ligand_pdb, is_ligand=True)
+        if read_pdb:
+            self._add_pdb(pdb)
+            if ligand_pdb != None:
+                self._add_pdb(ligand_pdb, is_ligand=True)
+
+
+    @property
+    def output(self) -> Optional[Dict[str, Any]]:
+        return self._output
+
+
+    @output.setter
+    def output(self, output: Optional[Dict[str, Any]]) -> None:
+        self._output = output
+        self._parsed = ParsedOutput(output["output"]) if output != None and output.get("output") != None else None
 
 
     @property
@@ -38,7 +59,7 @@ class Job(object):
         if self.output == None:
             return None
         else:
-            return self.output["output"]["pdb_kv"]
+            return pdb_kv_text(self.output["output"])
 
 
     @property
@@ -57,9 +78,26 @@ class Job(object):
             return self.output["output"]["log"]
 
 
+    @property
+    def parsed_report(self) -> Optional[Dict[str, Any]]:
+        """ Report as a dictionary, parsed once """
+        return self._parsed.report if self._parsed != None else None
+
+
+    @property
+    def cavities(self) -> Optional['np.ndarray']:
+        """ Cavity points as a structured array (see results.CAVITY_DTYPE), parsed once """
+        return self._parsed.cavities if self._parsed != None else None
+
+
+    def release(self) -> None:
+        """ Keep only the parsed report and cavities (call after export, which writes the raw cavity) """
+        if self._parsed != None:
+            self._parsed.release()
+
+
     def _add_pdb(self, pdb_fn: str, is_ligand: bool=False) -> None:
-        with open(pdb_fn) as f:
-            pdb = f.readlines()
+        pdb, _ = load_pdb(pdb_fn)
         if is_ligand:
             self.input["pdb_ligand"] = pdb
         else:
@@ -96,18 +134,23 @@ class Job(object):
 
 
     @classmethod
-    def load(cls, fn: Optional[str]):
+    def load(cls, fn: Optional[str], read_pdb: bool=True):
         """ Load Job from job.toml """
         # Read job file
         with open(fn, 'r') as f:
             job = toml.load(f=f)
+        return cls.from_metadata(job, read_pdb)
 
+
+    @classmethod
+    def from_metadata(cls, job: Dict[str, Any], read_pdb: bool=True):
+        """ Job from the contents of a job.toml """
         pdb = job['files']['pdb']
         ligand_pdb = job['files']['ligand'] if 'ligand' in job['files'].keys() else None
         removal_distance = job['cutoffs']['removal_distance']
         probe_out = job['probes']['probe_out']
 
-        return cls(pdb, ligand_pdb, probe_out, removal_distance)
+        return cls(pdb, ligand_pdb, probe_out, removal_distance, read_pdb)
 
     
     def export(self) -> None:
@@ -119,14 +162,17 @@ class Job(object):
         except FileExistsError:
             pass
 
-        # Export cavity
+        # Export cavity (None when it was already streamed to cavity_fn)
         cavity_fn = os.path.join(base_dir, f'{self.base_name}.KVFinder.output.pdb')
-        with open(cavity_fn, 'w') as f:
-            f.write(self.cavity)
+        if self.cavity != None:
+            with open(cavity_fn, 'w') as f:
+                f.write(self.cavity)
 
         # Export report
         report_fn = os.path.join(base_dir, f'{self.base_name}.KVFinder.results.toml')
-        report = toml.loads(self.report)
+        # copy FILES_PATH, the parsed report is kept on the job
+        report = dict(self.parsed_report)
+        report['FILES_PATH'] = dict(report['FILES_PATH'])
         report['FILES_PATH']['INPUT'] = self.pdb
         report['FILES_PATH']['LIGAND'] = self.ligand
         report['FILES_PATH']['OUTPUT'] = cavity_fn
@@ -233,9 +279,86 @@ class Dataset(object):
         return read_csv(os.path.join(dirname, 'statistics.txt'), sep='\t')
 
 
+class BenchmarkStore(object):
+    """ Benchmark records of every run in one SQLite database, queryable by run
+
+    runs: run_id, started_at, git_rev, n_workers, server, params (JSON)
+    jobs: one row per retrieved job, with its timings, timestamps, sizes and parameters
+    submissions: one row per /create request of a LoadGenerator
+
+    Rows are written in batches, one transaction each; WAL mode lets a Sender and a Retriever write at once.
+    """
+
+    schema = {
+        'runs': (('run_id', 'TEXT PRIMARY KEY'), ('started_at', 'TEXT'), ('git_rev', 'TEXT'), ('n_workers', 'INTEGER'), ('server', 'TEXT'), ('params', 'TEXT')),
+        'jobs': (('run_id', 'TEXT'), ('pdb', 'TEXT'), ('id', 'TEXT'), ('n_atoms', 'INTEGER'), ('n_heavy_atoms', 'INTEGER'), ('total_time', 'REAL'), ('elapsed_time', 'REAL'), ('worker_time', 'REAL'), ('json_size', 'INTEGER'), ('probe_out', 'REAL'), ('removal_distance', 'REAL'), ('n_workers', 'INTEGER'), ('created_at', 'TEXT'), ('started_at', 'TEXT'), ('ended_at', 'TEXT')),
+        'submissions': (('run_id', 'TEXT'), ('pdb', 'TEXT'), ('id', 'TEXT'), ('scheduled', 'REAL'), ('sent', 'REAL'), ('latency', 'REAL'), ('status_code', 'INTEGER'), ('error', 'TEXT'), ('probe_out', 'REAL'), ('removal_distance', 'REAL')),
+    }
+
+    def __init__(self, fn: str='results/benchmark.sqlite'):
+        self.fn = fn
+        self.connection = sqlite3.connect(fn, timeout=30.0)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            for table, columns in self.schema.items():
+                self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(f'{name} {kind}' for name, kind in columns)})")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run_id)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS submissions_run ON submissions (run_id)')
+
+    def start_run(self, n_workers: Optional[int]=None, server: Optional[str]=None, params: Optional[Dict[str, Any]]=None) -> str:
+        """ Register a new run, returning its id """
+        run_id = uuid.uuid4().hex[:12]
+        self.add('runs', [{
+            'run_id': run_id,
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'git_rev': git_revision(),
+            'n_workers': n_workers,
+            'server': server,
+            'params': json.dumps(params) if params != None else None,
+        }])
+        return run_id
+
+    def add(self, table: str, records: Sequence[Dict[str, Any]]) -> None:
+        """ Insert records (dictionaries keyed by column, missing columns are NULL) in a single transaction """
+        columns = [name for name, _ in self.schema[table]]
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [tuple(record.get(column) for column in columns) for record in records],
+            )
+
+    def runs(self) -> pd.DataFrame:
+        return pd.read_sql_query('SELECT * FROM runs ORDER BY started_at', self.connection)
+
+    def read(self, table: str='jobs', runs: Optional[Sequence[str]]=None) -> pd.DataFrame:
+        """ Rows of a table, of the given runs only (default: all runs) """
+        if runs == None:
+            return pd.read_sql_query(f'SELECT * FROM {table}', self.connection)
+        return pd.read_sql_query(f"SELECT * FROM {table} WHERE run_id IN ({', '.join('?' * len(runs))})", self.connection, params=list(runs))
+
+    def import_table(self, time_fn: str='results/time-statistics.txt') -> str:
+        """ Load a time-statistics.txt of earlier campaigns as one run, returning its id """
+        data = Evaluator.read(time_fn)
+        run_id = self.start_run(params={'imported': time_fn})
+        records = data.assign(run_id=run_id).to_dict('records')
+        self.add('jobs', records)
+        return run_id
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def git_revision() -> Optional[str]:
+    """ Commit checked out in the working directory, None outside a git repository """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
 class Sender(object):
 
-    def __init__(self, server: str="http://localhost:8081"):
+    def __init__(self, server: str="http://localhost:8081", store: Optional[BenchmarkStore]=None, run_id: Optional[str]=None):
         # Define server
         self.server = f"{server}"
 
@@ -245,10 +368,9 @@ class Sender(object):
         except FileExistsError:
             pass
 
-        # Create time statistics file
-        if not os.path.exists('results/time-statistics.txt'):
-            with open('results/time-statistics.txt', 'w') as f:
-                f.write('pdb\tid\tn_atoms\ttotal_time\telapsed_time\tworker_time\tjson_size\tprobe_out\tremoval_distance\tn_workers\n')
+        # Benchmark records go to the run in results/benchmark.sqlite (a new run by default)
+        self.store = store if store != None else BenchmarkStore()
+        self.run_id = run_id if run_id != None else self.store.start_run(server=self.server)
 
     def run(self, job: Job):
         if self._submit(job):
@@ -275,122 +397,396 @@ class Sender(object):
             return False
 
 
+class LoadGenerator(Sender):
+    """ Open-loop submission: each job is sent at its arrival time, whether or not earlier ones finished
+
+    rate: jobs per second, evenly spaced ('constant') or with exponential gaps ('poisson')
+    trace: file with one arrival time in seconds per line, replayed instead of rate
+    workers: requests in flight at once; when all are busy the lag (sent - scheduled) grows and is recorded
+    """
+
+    def __init__(self, server: str="http://localhost:8081", rate: float=1.0, arrival: str='poisson', trace: Optional[str]=None, workers: int=16, seed: Optional[int]=None, store: Optional[BenchmarkStore]=None, run_id: Optional[str]=None):
+        super().__init__(server, store, run_id)
+        self.rate = rate
+        self.arrival = arrival
+        self.trace = trace
+        self.workers = workers
+        self.random = random.Random(seed)
+        # Bodies are gzipped, and chunk-uploaded over the server limits, as the client sends them; no retries, a
+        # refused or failed submission is recorded as it happened
+        self.client = KVClient(self.server, None, pool_size=workers, retries=0)
+
+    def arrivals(self, n: int) -> List[float]:
+        """ Seconds from the start at which each of n jobs is sent """
+        if self.trace != None:
+            with open(self.trace) as f:
+                times = sorted(float(line) for line in f if line.strip())[:n]
+            return [t - times[0] for t in times]
+        if self.arrival == 'constant':
+            return [i / self.rate for i in range(n)]
+        if self.arrival == 'poisson':
+            times, t = [], 0.0
+            for _ in range(n):
+                times.append(t)
+                t += self.random.expovariate(self.rate)
+            return times
+        raise ValueError(f'Unknown arrival process: {self.arrival}')
+
+    def run(self, jobs: Iterable[Job]) -> List[Dict[str, Any]]:
+        """ Submit jobs on the arrival schedule, returning (and storing as submissions of the run) one record per job """
+        jobs = list(jobs)
+        start = time.perf_counter()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for job, scheduled in zip(jobs, self.arrivals(len(jobs))):
+                delay = start + scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(self._send, job, scheduled, start))
+            records = [future.result() for future in futures]
+
+        self.store.add('submissions', [dict(record, run_id=self.run_id) for record in records])
+        elapsed = time.perf_counter() - start
+        errors = sum(1 for record in records if record['error'])
+        print(f'> Sent {len(records)} jobs in {elapsed:.1f} s ({len(records) / elapsed:.2f} jobs/s), {errors} errors')
+        return records
+
+    def _send(self, job: Job, scheduled: float, start: float) -> Dict[str, Any]:
+        sent = time.perf_counter() - start
+        record = {
+            'pdb': job.pdb,
+            'id': None,
+            'scheduled': round(scheduled, 6),
+            'sent': round(sent, 6),
+            'probe_out': job.input['settings']['probes']['probe_out'],
+            'removal_distance': job.input['settings']['cutoffs']['removal_distance'],
+        }
+        try:
+            payload = server_json(job.input).encode()
+            data, headers = self.client._encode(payload)
+            if len(data) > self.client.payload_limit or len(payload) > self.client.json_limit:
+                reference = self.client._upload(job)
+                if reference != None:
+                    data, headers = self.client._encode(reference)
+            r = self.client.session.post(self.server + '/create', data=data, headers=headers, timeout=self.client.timeout)
+            record['status_code'] = r.status_code
+            # 413 and 502 come with an empty body, the status line alone marks them as errors
+            body = ' '.join(r.text.split())[:200]
+            record['error'] = '' if r.ok else f'{r.status_code} {r.reason}' + (f': {body}' if body else '')
+        except requests.RequestException as e:
+            record['status_code'] = 0
+            record['error'] = type(e).__name__
+        record['latency'] = round(time.perf_counter() - start - sent, 6)
+        if record['status_code'] == 200:
+            job.id = r.json()['id']
+            job.output_directory = 'results'
+            job.base_name = job.id
+            job.status = 'queued'
+            job.save(job.id)
+            record['id'] = job.id
+        return record
+
+
+class JobTracker(object):
+    """ Jobs saved in .KVFinder-web, read once and indexed by id and by state
+
+    States are pending, retrieved, failed, cancelled, not_found, error (results could not be retrieved) and lost
+    (pending, but its job.toml is gone). They are kept in <directory>/progress.json, replaced atomically on save,
+    so an interrupted Retriever resumes without retrieving a job twice.
+    """
+
+    def __init__(self, directory: str='.KVFinder-web'):
+        self.directory = directory
+        self.progress_fn = os.path.join(directory, 'progress.json')
+        # id -> job.toml contents
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        # id -> state, and state -> ids
+        self.state: Dict[str, str] = {}
+        self.states: Dict[str, set] = {}
+
+        progress = {}
+        if os.path.exists(self.progress_fn):
+            with open(self.progress_fn) as f:
+                progress = json.load(f)
+        # finished jobs whose directory was already removed are only in the progress file
+        for job_id, state in progress.items():
+            self.set_state(job_id, state)
+        for entry in os.scandir(directory):
+            job_fn = os.path.join(entry.path, 'job.toml')
+            if entry.is_dir() and os.path.exists(job_fn):
+                with open(job_fn) as f:
+                    self.jobs[entry.name] = toml.load(f)
+                if entry.name not in self.state:
+                    self.set_state(entry.name, 'pending')
+        # removed by hand, or by an older Retriever that erased the directory before saving the progress
+        for job_id in self.ids('pending'):
+            if job_id not in self.jobs:
+                self.set_state(job_id, 'lost')
+
+    def ids(self, state: str) -> List[str]:
+        return list(self.states.get(state, ()))
+
+    def set_state(self, job_id: str, state: str) -> None:
+        if job_id in self.state:
+            self.states[self.state[job_id]].discard(job_id)
+        self.state[job_id] = state
+        self.states.setdefault(state, set()).add(job_id)
+
+    def save(self) -> None:
+        # write then rename, the progress file is never left half written
+        tmp = f'{self.progress_fn}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.progress_fn)
+
+    def job(self, job_id: str) -> Job:
+        """ Job ready to be retrieved and exported, without reading its PDB files """
+        job = Job.from_metadata(self.jobs[job_id], read_pdb=False)
+        job.id = job_id
+        job.output_directory = 'results'
+        job.base_name = job.id
+        return job
+
+    def expected_runtime(self, job_id: str) -> Optional[float]:
+        # atoms estimated from the file size (about 81 bytes per ATOM record), the PDB is not read
+        job = self.jobs[job_id]
+        try:
+            n_atoms = os.path.getsize(job['files']['pdb']) // 81
+        except OSError:
+            return None
+        return predict_runtime(n_atoms, job['probes']['probe_out'])
+
+
 class Retriever(object):
 
-    def __init__(self, server: str="http://localhost:8081", workers:int=1):
+    def __init__(self, server: str="http://localhost:8081", workers:int=1, concurrency: int=8, store: Optional[BenchmarkStore]=None, run_id: Optional[str]=None):
         # Define server
         self.server = f"{server}"
         
         # Register number of workers in KVFinder-web server
         self.workers = workers
+
+        # Benchmark records go to the run in results/benchmark.sqlite (a new run by default)
+        self.store = store if store != None else BenchmarkStore()
+        self.run_id = run_id if run_id != None else self.store.start_run(workers, self.server)
+
+        # Jobs retrieved at once
+        self.concurrency = concurrency
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=concurrency))
     
     def start(self):
 
-        # Get job IDs
-        jobs = self._get_jobs()        
-        
-        while len(jobs) > 0:
-            
-            msg = f'> Checking {len(jobs)} jobs!'
-            print(msg, end='', flush=True)
-            
-            for job_id in jobs:
-                
-                # Get job information
-                job_fn = os.path.join('.KVFinder-web', job_id, 'job.toml')
-
-                # Prepare job
-                job = Job.load(fn=job_fn)
-                job.id = job_id
-                job.output_directory = 'results'
-                job.base_name = job.id
-
-                # Get results
-                if self._get_results(job):
-                    # total_time
-                    total_time = dateutil.parser.parse(job.output['ended_at']) - dateutil.parser.parse(job.output['created_at'])
-                    total_time = f'{total_time.total_seconds():4f}'
-                    # elapsed_time
-                    elapsed_time = dateutil.parser.parse(job.output['ended_at']) - dateutil.parser.parse(job.output['started_at'])
-                    elapsed_time = f"{elapsed_time.total_seconds():4f}"
-                    # worker_time
-                    worker_time = dateutil.parser.parse(job.output['started_at']) - dateutil.parser.parse(job.output['created_at'])
-                    worker_time = f"{worker_time.total_seconds():4f}"
-                    # json_size
-                    json_size = sys.getsizeof(json.dumps(job.output))
-                    # n_atoms
-                    n_atoms = get_number_of_atoms(job.pdb)
-                    # po
-                    po = job.input['settings']['probes']['probe_out']
-                    # rd 
-                    rd = job.input['settings']['cutoffs']['removal_distance']
-                    
-                    # Save statistics
-                    with open('results/time-statistics.txt', 'a+') as out:
-                        out.write(f'{job.pdb}\t{job.id}\t{n_atoms}\t{total_time}\t{elapsed_time}\t{worker_time}\t{json_size}\t{po}\t{rd}\t{self.workers}\n')
-
-                    # Remove job from jobs list
-                    jobs.remove(job_id)
-
-                time.sleep(1)
-
-            print(len(msg) * '\b', end='', flush=True)
-
-
-    def _get_results(self, job) -> Optional[Dict[str, Any]]:
+        # Read every job once
+        tracker = JobTracker()
+
+        # Polling schedule, failed retrievals and time of next check for each job
+        schedules = {}
+        attempts = {}
+        next_check = {job_id: time.monotonic() for job_id in tracker.ids('pending')}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while tracker.ids('pending'):
+
+                pending = tracker.ids('pending')
+                msg = f'> Checking {len(pending)} jobs!'
+                print(msg, end='', flush=True)
+
+                # Ask the status of every job due to be checked at once
+                now = time.monotonic()
+                due = [job_id for job_id in pending if next_check[job_id] <= now]
+                statuses = self._get_statuses(due)
+
+                finished = []
+                for job_id in due:
+                    status = statuses.get(job_id, {}).get('status')
+                    if status == 'completed' or status == 'timed_out':
+                        finished.append(job_id)
+                    elif status in ('failed', 'cancelled', 'not_found'):
+                        # Will never have results
+                        tracker.set_state(job_id, status)
+                    else:
+                        # Back off while queued, check often once running
+                        if job_id not in schedules:
+                            schedules[job_id] = PollSchedule(expected_runtime=tracker.expected_runtime(job_id))
+                        next_check[job_id] = now + schedules[job_id].next(status)
+
+                # Retrieve finished jobs concurrently, their records are stored from this thread in one batch
+                records = list(executor.map(self._retrieve, [tracker.job(job_id) for job_id in finished], [statuses[job_id] for job_id in finished]))
+                for job_id, record in zip(finished, records):
+                    if record != None:
+                        tracker.set_state(job_id, 'retrieved')
+                    else:
+                        # Try again later, give up after 3 attempts
+                        attempts[job_id] = attempts.get(job_id, 0) + 1
+                        if attempts[job_id] >= 3:
+                            tracker.set_state(job_id, 'error')
+                        next_check[job_id] = time.monotonic() + 5.0
+                self.store.add('jobs', [record for record in records if record != None])
+                tracker.save()
+
+                # Job directories are only removed once their records and states are saved
+                for job_id, record in zip(finished, records):
+                    if record != None:
+                        self.erase_job_dir(os.path.join('.KVFinder-web', job_id))
+
+                print(len(msg) * '\b', end='', flush=True)
+
+                # Wait for the next job due to be checked
+                pending = tracker.ids('pending')
+                if len(pending) > 0:
+                    time.sleep(max(0.0, min(next_check[job_id] for job_id in pending) - time.monotonic()))
+
+
+    def _retrieve(self, job: Job, status: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """ Get and export the results of a finished job, returning its benchmark record (None on errors) """
+        try:
+            if not self._get_results(job, status):
+                return None
+            created_at = dateutil.parser.parse(job.output['created_at'])
+            started_at = dateutil.parser.parse(job.output['started_at'])
+            ended_at = dateutil.parser.parse(job.output['ended_at'])
+        except (requests.RequestException, OSError, ValueError, KeyError, TypeError) as e:
+            # one job failing must not lose the records of the others retrieved with it
+            with open('results/thread.log', 'a+') as f:
+                f.write(f">{job.id}\n")
+                f.write(repr(e) + '\n')
+            return None
+        try:
+            stats = structure_statistics(job.pdb)
+        except (OSError, ValueError):
+            # PDB moved or unreadable, the timings are kept without atom counts
+            stats = {'n_atoms': None, 'n_heavy_atoms': None}
+        return {
+            'run_id': self.run_id,
+            'pdb': job.pdb,
+            'id': job.id,
+            'n_atoms': stats['n_atoms'],
+            'n_heavy_atoms': stats['n_heavy_atoms'],
+            'total_time': (ended_at - created_at).total_seconds(),
+            'elapsed_time': (ended_at - started_at).total_seconds(),
+            'worker_time': (started_at - created_at).total_seconds(),
+            'json_size': job.output_size,
+            'probe_out': job.input['settings']['probes']['probe_out'],
+            'removal_distance': job.input['settings']['cutoffs']['removal_distance'],
+            'n_workers': self.workers,
+            'created_at': job.output['created_at'],
+            'started_at': job.output['started_at'],
+            'ended_at': job.output['ended_at'],
+        }
+
+    def _get_statuses(self, ids: list) -> Dict[str, Dict[str, Any]]:
+        # Status records without output, up to 1000 ids per request
+        statuses = {}
+        for i in range(0, len(ids), 1000):
+            try:
+                r = self.session.post(self.server + '/status', json={'ids': ids[i:i + 1000]})
+            except requests.RequestException as e:
+                # these jobs are checked again on the next pass
+                with open('results/thread.log', 'a+') as f:
+                    f.write(">status\n")
+                    f.write(repr(e) + '\n')
+                continue
+            if r.ok:
+                statuses.update((s['id'], s) for s in r.json())
+            else:
+                with open('results/thread.log', 'a+') as f:
+                    f.write(">status\n")
+                    f.write(str(r) + '\n')
+        return statuses
+
+    def _get_results(self, job, status: Dict[str, Any]) -> bool:
+        """ Export the results of a job finished with `status` (its /status record)
+
+        The cavity is streamed to disk through /{id}/output/pdb_kv, only report and log are kept in memory. Servers
+        without that endpoint, and Compact jobs, are read whole through /{id}.
+        """
+        job.status = status['status']
+        if job.status == 'timed_out':
+            # Timed out jobs have no results
+            job.output = status
+            job.output_size = 0
+            return True
+
+        base_dir = os.path.join(job.output_directory, job.id)
+        os.makedirs(base_dir, exist_ok=True)
+        cavity_fn = os.path.join(base_dir, f'{job.base_name}.KVFinder.output.pdb')
+        with self.session.get(f'{self.server}/{job.id}/output/pdb_kv', stream=True) as r:
+            if r.status_code == 404:
+                return self._get_job(job)
+            if not r.ok:
+                self._log_error(job, r)
+                return False
+            _write_chunks(r.iter_content(1 << 16), cavity_fn)
+        job.output_size = os.path.getsize(cavity_fn)
+
+        output = {'pdb_kv': None}
+        for name in ('report', 'log'):
+            r = self.session.get(f'{self.server}/{job.id}/output/{name}')
+            if not r.ok:
+                self._log_error(job, r)
+                return False
+            output[name] = r.text
+            job.output_size += len(r.content)
+
+        # Export report, log and parameters next to the cavity
+        job.output = dict(status, output=output)
+        job.export()
+        return True
+
+    def _get_job(self, job) -> bool:
         
-        r = requests.get(self.server + '/' + job.id)
+        r = self.session.get(self.server + '/' + job.id)
                 
         if r.ok:
             reply = r.json()
+            job.status = reply['status']
             if reply['status'] == 'completed' or reply['status'] == 'timed_out':
                 # Pass output to job class
                 job.output = reply
                 job.status = reply['status']
+                job.output_size = len(r.content)
 
-                # Export results
-                job.export()
-                
-                # Remove job directory
-                job_dn = os.path.join('.KVFinder-web', job.id)
-                self.erase_job_dir(job_dn)
+                # Export results (timed out jobs have none)
+                if reply.get('output') != None:
+                    job.export()
 
                 return True
+            return False
         else:
-            with open('results/thread.log', 'a+') as f:
-                f.write(f">{job.id}\n")
-                f.write(str(r) + '\n')
+            self._log_error(job, r)
             return False
 
     @staticmethod
-    def erase_job_dir(d) -> None:
-        for f in os.listdir(d):
-            f = os.path.join(d, f)
-            if os.path.isdir(f):
-                self.erase_job_dir(f)
-            else:
-                os.remove(f)
-        os.rmdir(d)
+    def _log_error(job, r) -> None:
+        with open('results/thread.log', 'a+') as f:
+            f.write(f">{job.id}\n")
+            f.write(str(r) + '\n')
 
-    def _get_jobs(self) -> list:       
-        return os.listdir('.KVFinder-web')
+    @staticmethod
+    def erase_job_dir(d) -> None:
+        shutil.rmtree(d, ignore_errors=True)
 
 
 class Evaluator(object):
 
-    def __init__(self, time_fn:str='results/time-statistics.txt'):
+    def __init__(self, time_fn:str='results/time-statistics.txt', db: str='results/benchmark.sqlite', runs: Optional[Sequence[str]]=None):
         # Create images directory in results directory
         try: 
             os.mkdir('results/images/')
         except FileExistsError:
             pass
 
-        # Read time data
-        self.data = self.read(time_fn)
+        # Read time data of the given runs (default: all), from the text file of older campaigns when there is no database
+        if os.path.exists(db):
+            self.data = BenchmarkStore(db).read('jobs', runs)
+        else:
+            self.data = self.read(time_fn)
 
     @staticmethod
     def read(time_fn: str):
-        data = pd.read_table(time_fn, index_col=False)
+        # ids are 64-bit tags, kept as text as in the jobs table
+        data = pd.read_table(time_fn, index_col=False, dtype={'id': str})
         return data
 
 
@@ -399,6 +795,87 @@ class Evaluator(object):
         self.hist()
 
 
+    def summary(self, metrics=('total_time', 'elapsed_time', 'worker_time'), n_boot: int=1000, confidence: float=0.95, seed: int=0, out: Optional[str]='results/summary') -> Dict[str, Any]:
+        """ Latency percentiles and throughput per number of kv-workers, written to <out>.json and <out>.txt
+
+        Percentiles (p50, p90, p99) and throughput get bootstrap confidence intervals from n_boot resamples.
+        Throughput (jobs/min) is jobs over the makespan of each run when the data has created_at and ended_at,
+        otherwise the capacity of the workers, 60 * n_workers / mean elapsed_time. Speedup and efficiency are relative
+        to 1 worker and only given for measured (makespan) throughput, capacity assumes perfect scaling.
+        """
+        rng = np.random.default_rng(seed)
+        alpha = (1 - confidence) / 2
+        report = {'confidence': confidence, 'n_boot': n_boot, 'workers': {}}
+        for workers, data in self.data.groupby('n_workers'):
+            row = {'jobs': len(data)}
+            for metric in metrics:
+                values = data[metric].to_numpy(dtype=float)
+                # each row of samples is one resample of the jobs
+                samples = values[rng.integers(0, len(values), (n_boot, len(values)))]
+                stats = {'mean': float(values.mean()), 'max': float(values.max())}
+                for q in (50, 90, 99):
+                    stats[f'p{q}'] = float(np.percentile(values, q))
+                    estimates = np.percentile(samples, q, axis=1)
+                    stats[f'p{q}_ci'] = [float(np.quantile(estimates, alpha)), float(np.quantile(estimates, 1 - alpha))]
+                row[metric] = stats
+            if 'created_at' in data and 'ended_at' in data and data['created_at'].notna().all():
+                # runs with the same number of workers follow each other, their makespans add up. The makespan of
+                # a run is the sum of the gaps between consecutive completions (from its first submission), and
+                # each resample draws those gaps, as the max of resampled jobs could never exceed the makespan
+                created = pd.to_datetime(data['created_at'], utc=True)
+                ended = pd.to_datetime(data['ended_at'], utc=True)
+                runs = data['run_id'] if 'run_id' in data else pd.Series(0, index=data.index)
+                makespan, spans = 0.0, np.zeros(n_boot)
+                for positions in data.groupby(runs).indices.values():
+                    origin = created.iloc[positions].min()
+                    completions = np.sort((ended.iloc[positions] - origin).dt.total_seconds().to_numpy())
+                    gaps = np.diff(completions, prepend=0.0)
+                    makespan += gaps.sum()
+                    spans += gaps[rng.integers(0, len(gaps), (n_boot, len(gaps)))].sum(axis=1)
+                estimates = 60 * len(data) / spans
+                row['jobs_per_min'] = 60 * len(data) / makespan
+                row['jobs_per_min_ci'] = [float(np.quantile(estimates, alpha)), float(np.quantile(estimates, 1 - alpha))]
+                row['throughput'] = 'makespan'
+            else:
+                elapsed = data['elapsed_time'].to_numpy(dtype=float)
+                estimates = 60 * workers / elapsed[rng.integers(0, len(elapsed), (n_boot, len(elapsed)))].mean(axis=1)
+                row['jobs_per_min'] = 60 * workers / elapsed.mean()
+                row['jobs_per_min_ci'] = [float(np.quantile(estimates, alpha)), float(np.quantile(estimates, 1 - alpha))]
+                row['throughput'] = 'capacity'
+            report['workers'][int(workers)] = row
+
+        # Speedup and efficiency relative to a single kv-worker, from measured throughput only
+        base = report['workers'].get(1)
+        for workers, row in report['workers'].items():
+            measured = base != None and base['throughput'] == 'makespan' and row['throughput'] == 'makespan'
+            row['speedup'] = row['jobs_per_min'] / base['jobs_per_min'] if measured else None
+            row['efficiency'] = row['speedup'] / workers if measured else None
+
+        if out != None:
+            with open(f'{out}.json', 'w') as f:
+                json.dump(report, f, indent=2)
+            with open(f'{out}.txt', 'w') as f:
+                f.write(self.summary_table(report, metrics[0]))
+        return report
+
+
+    @staticmethod
+    def summary_table(report: Dict[str, Any], metric: str='total_time') -> str:
+        """ Text table of a summary report for one latency metric """
+        ci_name = f"{report['confidence']:.0%} CI"
+        header = f"{'workers':>7} {'jobs':>6} {'p50 (s)':>9} {'p90 (s)':>9} {'p99 (s)':>9} {'max (s)':>9} {'jobs/min':>9} {ci_name:>17} {'speedup':>7} {'eff.':>5}"
+        lines = [f'# {metric}', header]
+        for workers, row in sorted(report['workers'].items()):
+            stats = row[metric]
+            ci = '-' if row['jobs_per_min_ci'] == None else '{:.2f}-{:.2f}'.format(*row['jobs_per_min_ci'])
+            speedup = '-' if row['speedup'] == None else f"{row['speedup']:.2f}"
+            efficiency = '-' if row['efficiency'] == None else f"{row['efficiency']:.2f}"
+            lines.append(f"{workers:>7} {row['jobs']:>6} {stats['p50']:>9.2f} {stats['p90']:>9.2f} {stats['p99']:>9.2f} {stats['max']:>9.2f} {row['jobs_per_min']:>9.2f} {ci:>17} {speedup:>7} {efficiency:>5}")
+        if any(row['throughput'] == 'capacity' for row in report['workers'].values()):
+            lines.append('# jobs/min: capacity (60 * workers / mean elapsed_time), not measured; no speedup without timestamps')
+        return '\n'.join(lines) + '\n'
+
+
     # FIXME: Not useful results to plot yet
     def bar(self):
         # Create scatter directory in images directory
@@ -708,21 +1185,6 @@ class Evaluator(object):
             plt.savefig(f"results/images/histograms/worker_time_{worker}_kv-worker{'s' if worker > 1 else ''}.png", dpi=300)
 
 
-def get_number_of_atoms(pdb):
-    from Bio.PDB import PDBParser
-    # Read pdb
-    parser = PDBParser(PERMISSIVE=1, QUIET=True)
-    structure = parser.get_structure(f"{pdb.replace('kv1000/', '').replace('.pdb', '')}", pdb)
-    # Count number of atoms
-    n_atoms = 0
-    for model in structure:
-        for chain in model:
-            for residue in chain:
-                for atom in residue:
-                    n_atoms += 1
-    return n_atoms
-
-
 if __name__ == "__main__":
     # Load Dataset Information
     dataset = Dataset()
@@ -740,28 +1202,30 @@ if __name__ == "__main__":
     #     # Docker up
     #     os.system(f'docker-compose up -d --scale kv-worker={workers}')
 
-    #     # Create and Configure Sender
-    #     sender = Sender(server="http://localhost:8081")
+    #     # Register the run in results/benchmark.sqlite
+    #     store = BenchmarkStore()
+    #     run_id = store.start_run(workers, "http://localhost:8081", params={'rate': 2.0, 'arrival': 'poisson'})
+
+    #     # Create and Configure LoadGenerator (jobs arrive at 2 jobs/s, as a Poisson process)
+    #     sender = LoadGenerator(server="http://localhost:8081", rate=2.0, arrival='poisson', store=store, run_id=run_id)
 
     #     print("> Sending jobs to KV Server")
 
     #     # Send jobs to KV server
+    #     jobs = []
     #     for pdb in dataset.pdb_list:
-    #         print(f'> {pdb}', end='', flush=True)       
     #         for po in [4.0, 6.0, 8.0]:
-    #             job = Job(pdb=pdb, probe_out=po, removal_distance=2.4)
-    #             sender.run(job)
+    #             jobs.append(Job(pdb=pdb, probe_out=po, removal_distance=2.4))
     #         for rd in [0.0, 0.6, 1.2]:
-    #             job = Job(pdb=pdb, probe_out=4.0, removal_distance=rd)
-    #             sender.run(job)
-    #         print('\b' * 19, end='', flush=True)
+    #             jobs.append(Job(pdb=pdb, probe_out=4.0, removal_distance=rd))
+    #     sender.run(jobs)
         
     #     time.sleep(60)
 
     #     print("> Retrieving jobs from KV Server")
 
     #     # Create and Configure Retriever
-    #     retriever = Retriever(server="http://localhost:8081", workers=workers)
+    #     retriever = Retriever(server="http://localhost:8081", workers=workers, store=store, run_id=run_id)
     #     # Start retriever
     #     retriever.start()
 
@@ -770,4 +1234,5 @@ if __name__ == "__main__":
 
     # Create and configure evaluator
     evaluator = Evaluator()
+    print(Evaluator.summary_table(evaluator.summary()))
     evaluator.plots()
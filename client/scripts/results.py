@@ -0,0 +1,161 @@
+import base64
+from typing import Optional, Any, Dict
+
+
+# One record per cavity point
+CAVITY_DTYPE = [('cavity', 'U3'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8'), ('surface', '?')]
+
+
+def decode_compact(compact: Dict[str, Any]) -> 'numpy.ndarray':
+    """ Cavity points of a pdb_kv_compact output as a CAVITY_DTYPE structured array """
+    import numpy as np
+
+    dtype = np.dtype('<' + compact['dtype'])
+    indices = np.frombuffer(base64.b64decode(compact['points']), dtype=dtype).reshape(-1, 3)
+    n = len(indices)
+    points = np.empty(n, dtype=CAVITY_DTYPE)
+    xyz = np.asarray(compact['origin']) + indices * compact['scale']
+    # the text output has 3 decimals, rounding drops the float error of origin + scale * index
+    xyz = np.round(xyz, 3)
+    points['x'], points['y'], points['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    points['cavity'] = np.repeat(np.asarray(compact['cavities'], dtype='U3'), compact['counts'])
+    surface = np.frombuffer(base64.b64decode(compact['surface']), dtype=np.uint8)
+    points['surface'] = np.unpackbits(surface, bitorder='little')[:n].astype(bool)
+    return points
+
+
+def encode_compact(points: 'numpy.ndarray', step: float=0.6) -> Dict[str, Any]:
+    """ pdb_kv_compact of CAVITY_DTYPE points, built as the server builds it from pdb_kv (CompactCavities::from_pdb)
+
+    Cavities keep the order they first appear in, points are grouped by cavity. Points are grid indices ('u2') when
+    they all sit on the grid of spacing step, thousandths of angstrom ('i4') otherwise.
+    """
+    import numpy as np
+
+    names, first, inverse = np.unique(points['cavity'], return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    cavity = rank[inverse.reshape(-1)]
+    points = points[np.argsort(cavity, kind='stable')]
+    xyz = np.stack([points['x'], points['y'], points['z']], axis=1)
+    origin = xyz.min(axis=0) if len(points) else np.zeros(3)
+    # non-negative, so floor(v + 0.5) rounds half away from zero as f64::round does
+    index = np.floor((xyz - origin) / step + 0.5)
+    on_grid = bool(np.all((index <= 65535) & (np.abs(origin + index * step - xyz) < 0.0005)))
+    if on_grid:
+        scale, dtype, values = step, 'u2', index.astype('<u2')
+    else:
+        scale, dtype = 0.001, 'i4'
+        values = np.floor((xyz - origin) / scale + 0.5).astype('<i4')
+    return {
+        'scale': scale,
+        'origin': [float(v) for v in origin],
+        'dtype': dtype,
+        'cavities': [str(name) for name in names[order]],
+        'counts': [int(n) for n in np.bincount(cavity, minlength=len(order))],
+        'points': base64.b64encode(values.tobytes()).decode(),
+        'surface': base64.b64encode(np.packbits(points['surface'], bitorder='little').tobytes()).decode(),
+    }
+
+
+def parse_pdb_kv(pdb_kv: str) -> 'numpy.ndarray':
+    """ Cavity points of a pdb_kv text as a CAVITY_DTYPE structured array
+
+    The fixed-width columns (name 13-16, residue 18-20, x, y, z 31-54) are cut from all ATOM records at once.
+    """
+    import numpy as np
+
+    lines = [line for line in pdb_kv.splitlines() if line.startswith('ATOM')]
+    points = np.empty(len(lines), dtype=CAVITY_DTYPE)
+    if not lines:
+        return points
+    records = np.array(lines, dtype='S54').view(np.uint8).reshape(len(lines), 54)
+    xyz = np.ascontiguousarray(records[:, 30:54]).view('S8').astype(float)
+    points['x'], points['y'], points['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    points['cavity'] = np.char.strip(np.ascontiguousarray(records[:, 17:20]).view('S3')[:, 0]).astype('U3')
+    points['surface'] = np.char.strip(np.ascontiguousarray(records[:, 12:16]).view('S4')[:, 0]) == b'HS'
+    return points
+
+
+def format_pdb_kv(points: 'numpy.ndarray') -> str:
+    """ pdb_kv text of CAVITY_DTYPE points, with the records parKVFinder writes (HS for surface points, H otherwise)
+
+    Equivalent to the server text point for point (cavity, coordinates, surface), not byte for byte.
+    """
+    lines = []
+    for i, point in enumerate(points):
+        atom = 'HS' if point['surface'] else 'H'
+        lines.append(f"ATOM  {(i + 1) % 100000:5d}  {atom:<3} {point['cavity']}   259    {point['x']:8.3f}{point['y']:8.3f}{point['z']:8.3f}  1.00  0.00\n")
+    return ''.join(lines)
+
+
+def pdb_kv_text(output: Dict[str, Any]) -> Optional[str]:
+    """ pdb_kv of a job output, rebuilt from pdb_kv_compact for jobs asked in the Compact format (their pdb_kv is empty) """
+    if not output.get('pdb_kv') and output.get('pdb_kv_compact') != None:
+        return format_pdb_kv(decode_compact(output['pdb_kv_compact']))
+    return output.get('pdb_kv')
+
+
+def read_report(report: str) -> Dict[str, Any]:
+    """ Report TOML as a dictionary """
+    try:
+        # Python 3.11+, much faster than toml
+        import tomllib
+        return tomllib.loads(report)
+    except ImportError:
+        import toml
+        return toml.loads(report)
+
+
+def parse_report(report: str) -> Dict[str, 'pandas.DataFrame']:
+    """ RESULTS tables of a report as DataFrames
+
+    volume: cavity, volume; area: cavity, area; residues: cavity, residue, chain, resname
+    """
+    import pandas as pd
+
+    results = read_report(report).get('RESULTS', {})
+    volume = results.get('VOLUME', {})
+    area = results.get('AREA', {})
+    residues = results.get('RESIDUES', {})
+    return {
+        'volume': pd.DataFrame({'cavity': list(volume), 'volume': list(volume.values())}),
+        'area': pd.DataFrame({'cavity': list(area), 'area': list(area.values())}),
+        'residues': pd.DataFrame(
+            [[cavity] + list(residue[:3]) for cavity, rows in residues.items() for residue in rows],
+            columns=['cavity', 'residue', 'chain', 'resname'],
+        ),
+    }
+
+
+class ParsedOutput(object):
+    """ Report and cavity points of a job output, parsed on first access and kept afterwards """
+
+    def __init__(self, output: Dict[str, Any]):
+        self.output = output
+        self._report: Optional[Dict[str, Any]] = None
+        self._cavities: Optional['numpy.ndarray'] = None
+
+    @property
+    def report(self) -> Optional[Dict[str, Any]]:
+        if self._report == None and self.output.get('report') != None:
+            self._report = read_report(self.output['report'])
+        return self._report
+
+    @property
+    def cavities(self) -> Optional['numpy.ndarray']:
+        if self._cavities is None:
+            if self.output.get('pdb_kv_compact') != None:
+                self._cavities = decode_compact(self.output['pdb_kv_compact'])
+            elif self.output.get('pdb_kv') != None:
+                self._cavities = parse_pdb_kv(self.output['pdb_kv'])
+        return self._cavities
+
+    def release(self) -> None:
+        """ Parse report and cavities, then drop their raw strings from the output """
+        self.report
+        self.cavities
+        for key in ('report', 'pdb_kv', 'pdb_kv_compact'):
+            if key in self.output:
+                self.output[key] = None
@@ -0,0 +1,143 @@
+import io
+import os
+import hashlib
+import zipfile
+import threading
+from typing import Optional, Any, Dict, IO, Iterator, List, Tuple, Union
+
+
+# residue names of water molecules
+WATERS = ('HOH', 'WAT', 'H2O', 'DOD', 'TIP', 'SOL')
+
+# blake2b digest of a PDB file -> its atom statistics
+_statistics: Dict[str, Dict[str, Any]] = {}
+_statistics_lock = threading.Lock()
+
+
+def load_pdb(pdb_fn: Union[str, IO[str]], model: Optional[int]=None, altloc: Optional[str]='A', hydrogens: bool=True, waters: bool=True) -> Tuple[List[str], Dict[str, int]]:
+    """ Read only the ATOM/HETATM records parKVFinder uses from a PDB file
+
+    model: serial of the MODEL to keep (default: first model in the file)
+    altloc: alternate location to keep besides blank ones (None keeps all)
+    hydrogens, waters: keep hydrogen atoms and water molecules
+
+    pdb_fn may also be an open text file, e.g. a zip member from iter_structures.
+    Returns the kept lines and a summary of lines and bytes read, kept and saved.
+    """
+    if isinstance(pdb_fn, str):
+        with open(pdb_fn) as f:
+            return load_pdb(f, model, altloc, hydrogens, waters)
+    lines = []
+    stats = {'lines_read': 0, 'lines_kept': 0, 'bytes_read': 0, 'bytes_kept': 0}
+    current_model = None
+    for line in pdb_fn:
+        stats['lines_read'] += 1
+        stats['bytes_read'] += len(line)
+        if line.startswith('MODEL'):
+            serial = int(line[10:14]) if line[10:14].strip() else 1
+            if model == None:
+                model = serial
+            current_model = serial
+            continue
+        if not line.startswith(('ATOM', 'HETATM')):
+            continue
+        if current_model != None and current_model != model:
+            continue
+        if altloc != None and line[16:17] not in (' ', '', altloc):
+            continue
+        if not waters and line[17:20].strip() in WATERS:
+            continue
+        if not hydrogens and _is_hydrogen(line):
+            continue
+        lines.append(line)
+        stats['lines_kept'] += 1
+        stats['bytes_kept'] += len(line)
+    stats['bytes_saved'] = stats['bytes_read'] - stats['bytes_kept']
+    return lines, stats
+
+
+def iter_structures(source: str, suffixes: Tuple[str, ...]=('.pdb', '.ent')) -> Iterator[Tuple[str, IO[str]]]:
+    """ (name, open text file) of each structure in a directory or zip archive, in name order
+
+    Zip members are read straight from the archive, without extracting it. Each file is closed when the next one is requested.
+    """
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for name in sorted(archive.namelist()):
+                if name.lower().endswith(suffixes):
+                    with io.TextIOWrapper(archive.open(name), errors='replace') as f:
+                        yield name, f
+    else:
+        for name in sorted(os.listdir(source)):
+            if name.lower().endswith(suffixes):
+                with open(os.path.join(source, name), errors='replace') as f:
+                    yield name, f
+
+
+def _is_hydrogen(line: str) -> bool:
+    # element symbol (columns 77-78), falling back to the first letter of the atom name
+    element = line[76:78].strip()
+    if not element:
+        element = line[12:16].strip().lstrip('0123456789')[:1]
+    return element in ('H', 'D')
+
+
+def get_coordinates(lines: List[str]) -> 'numpy.ndarray':
+    """ (n, 3) array with the x, y, z columns (31-54) of the given records, parsed in a single pass """
+    import numpy as np
+
+    if any(len(line) < 54 for line in lines):
+        raise ValueError('Record too short for coordinates')
+    fields = ''.join(line[30:54] for line in lines).encode('ascii')
+    return np.frombuffer(fields, dtype='S8').astype(float).reshape(-1, 3)
+
+
+def get_pdb_boundaries(lines: List[str], padding: float=0.0) -> Optional[Tuple['numpy.ndarray', 'numpy.ndarray']]:
+    """ Minimum and maximum x, y, z of the ATOM records grown by `padding`, as in kv::Input::get_pdb_boundaries
+
+    Returns None when there is no ATOM record or a coordinate cannot be parsed (the server "parsing error").
+    """
+    atoms = [line for line in lines if line.startswith('ATOM')]
+    if not atoms:
+        return None
+    try:
+        xyz = get_coordinates(atoms)
+    except ValueError:
+        return None
+    return xyz.min(axis=0) - padding, xyz.max(axis=0) + padding
+
+
+def structure_statistics(pdb_fn: str, probe_out: float=4.0, step: float=0.6) -> Dict[str, Any]:
+    """ Atom count, heavy atom count, bounding box and grid estimate of the records load_pdb keeps from a PDB file
+
+    The records are scanned once as fixed-width columns; the atom statistics are memoized by the file contents hash,
+    so the same structure is only parsed once per process. grid_points and grid_volume estimate the parKVFinder grid:
+    the bounding box grown by probe_out, sampled every `step` angstroms.
+    """
+    import numpy as np
+
+    with open(pdb_fn, 'rb') as f:
+        data = f.read()
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    with _statistics_lock:
+        stats = _statistics.get(digest)
+    if stats == None:
+        lines, _ = load_pdb(io.StringIO(data.decode(errors='replace')))
+        stats = {'n_atoms': len(lines), 'n_heavy_atoms': 0, 'min': None, 'max': None}
+        if lines:
+            xyz = get_coordinates(lines)
+            records = np.array([line.rstrip('\n').encode() for line in lines], dtype='S80').view(np.uint8).reshape(len(lines), 80)
+            # element symbol (columns 77-78), falling back to the first letter of the atom name, as in _is_hydrogen
+            element = np.char.strip(np.ascontiguousarray(records[:, 76:78]).view('S2')[:, 0])
+            name = np.char.lstrip(np.char.strip(np.ascontiguousarray(records[:, 12:16]).view('S4')[:, 0]), b'0123456789')
+            element = np.where(element == b'', name.astype('S1'), element)
+            stats.update(n_heavy_atoms=int(np.count_nonzero(~np.isin(element, (b'H', b'D')))), min=xyz.min(axis=0), max=xyz.max(axis=0))
+        with _statistics_lock:
+            _statistics[digest] = stats
+
+    stats = dict(stats, hash=digest, grid_points=0, grid_volume=0.0)
+    if stats['n_atoms'] > 0:
+        shape = np.ceil((stats['max'] - stats['min'] + 2 * probe_out) / step).astype(int) + 1
+        stats['grid_points'] = int(np.prod(shape))
+        stats['grid_volume'] = float(np.prod((shape - 1) * step))
+    return stats
@@ -0,0 +1,95 @@
+import copy
+from cache import job_tag, server_json, city_hash64, _f64
+
+# Regression vectors for the job tag the client computes before sending a job. kv::webserver::create tags a job
+# with city::hash64 of serde_json::to_string(&Input) (serde_json 1.0.62, no float_roundtrip); a change here
+# means jobs are no longer found by the tag the server gave them.
+
+PDB = ["ATOM      1  N   MET A   1      27.340  24.430   2.614  1.00  9.67           N\n"]
+
+INPUT = {
+    'pdb': PDB,
+    'settings': {
+        'modes': {
+            'whole_protein_mode': True,
+            'box_mode': False,
+            'resolution_mode': 'Low',
+            'surface_mode': True,
+            'kvp_mode': False,
+            'ligand_mode': False,
+        },
+        'step_size': {'step_size': 0.0},
+        'probes': {'probe_in': 1.4, 'probe_out': 4.0},
+        'cutoffs': {'volume_cutoff': 5.0, 'ligand_cutoff': 5.0, 'removal_distance': 0.0},
+        'visiblebox': {p: {'x': 0.0, 'y': 0.0, 'z': 0.0} for p in ('p1', 'p2', 'p3', 'p4')},
+        'internalbox': {
+            'p1': {'x': -4.0, 'y': -4.0, 'z': -4.0},
+            'p2': {'x': 4.0, 'y': -4.0, 'z': -4.0},
+            'p3': {'x': -4.0, 'y': 4.0, 'z': -4.0},
+            'p4': {'x': -4.0, 'y': -4.0, 'z': 4.0},
+        },
+    },
+}
+
+
+def _input(**changes):
+    input = copy.deepcopy(INPUT)
+    for path, value in changes.items():
+        *keys, last = path.split('.')
+        target = input
+        for key in keys:
+            target = target[key]
+        target[last] = value
+    return input
+
+
+def test_server_json():
+    assert server_json(INPUT) == (
+        '{"settings":{"modes":{"whole_protein_mode":true,"box_mode":false,"resolution_mode":"Low","surface_mode":true,'
+        '"kvp_mode":false,"ligand_mode":false},"step_size":{"step_size":0.0},"probes":{"probe_in":1.4,"probe_out":4.0},'
+        '"cutoffs":{"volume_cutoff":5.0,"ligand_cutoff":5.0,"removal_distance":0.0},'
+        '"visiblebox":{"p1":{"x":0.0,"y":0.0,"z":0.0},"p2":{"x":0.0,"y":0.0,"z":0.0},"p3":{"x":0.0,"y":0.0,"z":0.0},'
+        '"p4":{"x":0.0,"y":0.0,"z":0.0}},'
+        '"internalbox":{"p1":{"x":-4.0,"y":-4.0,"z":-4.0},"p2":{"x":4.0,"y":-4.0,"z":-4.0},'
+        '"p3":{"x":-4.0,"y":4.0,"z":-4.0},"p4":{"x":-4.0,"y":-4.0,"z":4.0}}},'
+        '"pdb":["ATOM      1  N   MET A   1      27.340  24.430   2.614  1.00  9.67           N\\n"],"pdb_ligand":null}'
+    )
+
+
+def test_job_tag():
+    vectors = [
+        (INPUT, '15113076932202065755'),
+        (_input(**{'output_format': 'Compact'}), '17035534142062292475'),
+        (_input(**{
+            'pdb_ligand': ["HETATM    1  C1  LIG A 900       1.000   2.000   3.000  1.00  0.00           C\n"],
+            'settings.modes.ligand_mode': True,
+        }), '208979261931031912'),
+        (_input(**{'settings.visiblebox.p1': {'x': 1e16, 'y': -0.5, 'z': 1e-7}}), '14163744413333408779'),
+        # 17 significant digits are rounded to 15, as sent to the server
+        (_input(**{'settings.probes.probe_out': 0.1 + 0.2}), '6507476885262566161'),
+        (_input(**{'settings.probes.probe_out': 0.3}), '6507476885262566161'),
+    ]
+    for input, tag in vectors:
+        assert job_tag(input) == tag
+
+
+def test_f64():
+    vectors = [
+        (0.0, '0.0'),
+        (4, '4.0'),
+        (-2.5, '-2.5'),
+        (0.0001, '0.0001'),
+        (1e-7, '1e-7'),
+        (1e15, '1000000000000000.0'),
+        (1e16, '1e16'),
+        (0.1 + 0.2, '0.3'),
+        (123456789012345678.0, '1.23456789012346e17'),
+    ]
+    for value, text in vectors:
+        assert _f64(value) == text
+
+
+def test_city_hash64():
+    assert city_hash64(b'') == 11160318154034397263
+    assert city_hash64(b'KVFinder') == 13689011934781250682
+    assert city_hash64(bytes(range(256)) * 5) == 7856961409980726037
@@ -1,9 +1,12 @@
 use actix_web::{error, web, App, HttpRequest, HttpResponse, HttpServer};
 use kv;
+use reqwest;
 
 fn json_error_handler(err: error::JsonPayloadError, _req: &HttpRequest) -> error::Error {
-    let msg = String::from("Please update your plugin");
-    let resp = HttpResponse::BadRequest().body(msg);
+    let resp = match err {
+        error::JsonPayloadError::Overflow => HttpResponse::PayloadTooLarge().finish(),
+        _ => HttpResponse::BadRequest().body(String::from("Please update your plugin")),
+    };
     error::InternalError::from_response(err, resp).into()
 }
 
@@ -13,16 +16,29 @@ fn main() {
     // job timeout 30 minutes, expires after 1 day
     kv::webserver::create_ocypod_queue("kvfinder", "30m", "1d", 0);
 
-    HttpServer::new(|| {
+    // queue client shared by the /{id}/wait and /status handlers
+    let client = reqwest::Client::new();
+
+    HttpServer::new(move || {
         App::new()
+            .data(client.clone())
             .data(
                 web::JsonConfig::default()
-                    .limit(1_000_000)
+                    .limit(kv::webserver::JSON_LIMIT)
                     .error_handler(json_error_handler),
             )
             .route("/", web::get().to(kv::webserver::hello))
             .route("/{id}", web::get().to(kv::webserver::ask))
+            .route("/{id}/wait", web::get().to_async(kv::webserver::wait))
+            .route("/{id}/output/{name}", web::get().to(kv::webserver::output))
             .route("/create", web::post().to(kv::webserver::create))
+            .route("/status", web::post().to_async(kv::webserver::status))
+            .route("/upload/missing", web::post().to(kv::webserver::missing))
+            .service(
+                web::resource("/upload/{hash}")
+                    .data(web::PayloadConfig::new(kv::webserver::CHUNK_LIMIT))
+                    .route(web::put().to(kv::webserver::upload)),
+            )
     })
     .bind("0.0.0.0:8081")
     .expect("Cannot bind to port 8081")
@@ -154,12 +154,27 @@ mod kv {
         }
     }
 
+    #[derive(Serialize, Deserialize, PartialEq, Debug, Clone)]
+    #[serde(deny_unknown_fields)]
+    enum KVOutputFormat {
+        Text,
+        Compact,
+    }
+
     #[derive(Serialize, Deserialize, Debug)]
     #[serde(deny_unknown_fields)]
     pub struct Input {
         settings: KVSettings,
         pdb: Vec<String>,
         pdb_ligand: Option<Vec<String>>,
+        // skipped when absent so job tags of text output jobs are unchanged
+        #[serde(default, skip_serializing_if = "Option::is_none")]
+        output_format: Option<KVOutputFormat>,
+        // hashes of chunks uploaded to /upload/{hash}, replaced by pdb and pdb_ligand before the job is tagged
+        #[serde(default, skip_serializing_if = "Option::is_none")]
+        pdb_chunks: Option<Vec<String>>,
+        #[serde(default, skip_serializing_if = "Option::is_none")]
+        pdb_ligand_chunks: Option<Vec<String>>,
     }
 
     impl Input {
@@ -278,6 +293,96 @@ mod kv {
         pdb_kv: String,
         report: String,
         log: String,
+        #[serde(default, skip_serializing_if = "Option::is_none")]
+        pdb_kv_compact: Option<CompactCavities>,
+    }
+
+    // Cavity points of pdb_kv as little-endian arrays, base64 encoded.
+    // Point i is origin + scale * points[i]. Points are grouped by cavity, in the order of `cavities`,
+    // with counts[k] points in cavity k. Bit i of `surface` (least significant bit first) marks surface points.
+    #[derive(Serialize, Deserialize, Debug, Clone)]
+    pub struct CompactCavities {
+        scale: f64,
+        origin: [f64; 3],
+        // "u2" grid indices, or "i4" thousandths of angstrom when points are off the axis-aligned grid
+        dtype: String,
+        cavities: Vec<String>,
+        counts: Vec<u32>,
+        points: String,
+        surface: String,
+    }
+
+    impl CompactCavities {
+        fn from_pdb(pdb: &str, step: f64) -> Option<CompactCavities> {
+            // cavity, coordinates and surface flag of each point
+            let mut records: Vec<(usize, [f64; 3], bool)> = Vec::new();
+            let mut cavities: Vec<String> = Vec::new();
+            for line in pdb.lines().filter(|s| s.starts_with("ATOM")) {
+                let xyz = [
+                    line.get(30..38)?.trim().parse::<f64>().ok()?,
+                    line.get(38..46)?.trim().parse::<f64>().ok()?,
+                    line.get(46..54)?.trim().parse::<f64>().ok()?,
+                ];
+                let name = line.get(17..20)?.trim();
+                let cavity = match cavities.iter().position(|c| c == name) {
+                    Some(k) => k,
+                    None => {
+                        cavities.push(String::from(name));
+                        cavities.len() - 1
+                    }
+                };
+                records.push((cavity, xyz, line.get(12..16)?.trim() == "HS"));
+            }
+            records.sort_by_key(|r| r.0);
+
+            let mut origin = [std::f64::INFINITY; 3];
+            for r in &records {
+                for i in 0..3 {
+                    origin[i] = origin[i].min(r.1[i]);
+                }
+            }
+            if records.is_empty() {
+                origin = [0.0; 3];
+            }
+            let mut counts = vec![0u32; cavities.len()];
+            let mut surface = vec![0u8; (records.len() + 7) / 8];
+            for (i, r) in records.iter().enumerate() {
+                counts[r.0] += 1;
+                if r.2 {
+                    surface[i / 8] |= 1 << (i % 8);
+                }
+            }
+
+            // grid indices when every point sits on the grid (within the 3 decimals of the pdb)
+            let on_grid = records.iter().all(|r| {
+                (0..3).all(|i| {
+                    let index = ((r.1[i] - origin[i]) / step).round();
+                    index <= 65535.0 && (origin[i] + index * step - r.1[i]).abs() < 0.0005
+                })
+            });
+            let (scale, dtype) = if on_grid { (step, "u2") } else { (0.001, "i4") };
+            let mut points: Vec<u8> = Vec::with_capacity(records.len() * if on_grid { 6 } else { 12 });
+            for r in &records {
+                for i in 0..3 {
+                    let index = ((r.1[i] - origin[i]) / scale).round();
+                    if on_grid {
+                        points.extend_from_slice(&(index as u16).to_le_bytes());
+                    } else {
+                        points.extend_from_slice(&(index as i32).to_le_bytes());
+                    }
+                }
+            }
+
+            Some(CompactCavities {
+                scale,
+                origin,
+                dtype: String::from(dtype),
+                cavities,
+                counts,
+                points: base64::encode(&points),
+                surface: base64::encode(&surface),
+            })
+        }
     }
 
     #[derive(Serialize, Deserialize)]
@@ -287,7 +392,7 @@ mod kv {
     }
 
     pub mod worker {
-        use super::{Input, Output};
+        use super::{CompactCavities, Input, KVOutputFormat, Output};
         use reqwest;
         use serde::{Deserialize, Serialize};
         use std::fs;
@@ -330,11 +435,23 @@ mod kv {
                     .expect("failed to execute KVFinder process");
                 println!("process exited with: {}", kvfinder);
                 if kvfinder.success() {
+                    let pdb_kv = fs::read_to_string(format!(
+                        "{}/{}/KV_Files/KVFinderWeb/KVFinderWeb.KVFinder.output.pdb",
+                        config.job_path, self.id
+                    ))?;
+                    // grid spacing of the Low resolution mode, the only one accepted by Input::check
+                    let compact = match self.input.output_format {
+                        Some(KVOutputFormat::Compact) => CompactCavities::from_pdb(&pdb_kv, 0.6),
+                        _ => None,
+                    };
                     let output = Output {
-                        pdb_kv: fs::read_to_string(format!(
-                            "{}/{}/KV_Files/KVFinderWeb/KVFinderWeb.KVFinder.output.pdb",
-                            config.job_path, self.id
-                        ))?,
+                        // the text is dropped when the compact form could be built
+                        pdb_kv: if compact.is_some() {
+                            String::new()
+                        } else {
+                            pdb_kv
+                        },
+                        pdb_kv_compact: compact,
                         report: fs::read_to_string(format!(
                             "{}/{}/KV_Files/KVFinderWeb/KVFinderWeb.KVFinder.results.toml",
                             config.job_path, self.id
@@ -439,12 +556,23 @@ mod kv {
 
     pub mod webserver {
         use super::{Data, Input, Output};
-        use actix_web::{web, HttpResponse, Responder};
+        use actix_web::error::BlockingError;
+        use actix_web::http::header;
+        use actix_web::{web, HttpRequest, HttpResponse, Responder};
         use fasthash::city;
+        use futures::future::{ok, Either};
+        use num_cpus;
+        use futures::Future;
         use reqwest;
         use serde::{Deserialize, Serialize};
         use serde_json;
         use serde_json::json;
+        use std::env;
+        use std::fs;
+        use std::path::PathBuf;
+        use std::sync::atomic::{AtomicU64, AtomicUsize, Ordering};
+        use std::thread;
+        use std::time::{Duration, Instant, SystemTime, UNIX_EPOCH};
 
         #[derive(Serialize, Deserialize)]
         struct Job {
@@ -458,6 +586,47 @@ mod kv {
             expires_after: String,
         }
 
+        // job status without output, as returned by /status
+        #[derive(Serialize, Deserialize)]
+        struct JobStatus {
+            #[serde(default)]
+            id: String, // tag_id
+            status: String,
+            created_at: Option<String>,
+            started_at: Option<String>,
+            ended_at: Option<String>,
+            expires_after: Option<String>,
+        }
+
+        // status alone, as polled by /{id}/wait
+        #[derive(Deserialize)]
+        struct QueueStatus {
+            status: String,
+        }
+
+        #[derive(Serialize, Deserialize)]
+        pub struct StatusRequest {
+            ids: Vec<String>,
+        }
+
+        #[derive(Deserialize)]
+        pub struct WaitQuery {
+            timeout: Option<u64>,
+            // output=false replies with the status record only, for clients downloading /{id}/output/{name}
+            output: Option<bool>,
+        }
+
+        #[derive(Deserialize)]
+        pub struct ChunksRequest {
+            hashes: Vec<String>,
+        }
+
+        enum ChunkError {
+            Missing(Vec<String>),
+            TooLarge,
+            Invalid,
+        }
+
         #[derive(Serialize, Deserialize)]
         struct QueueConfig<'a> {
             timeout: &'a str,
@@ -465,6 +634,22 @@ mod kv {
             retries: i32,
         }
 
+        // maximum request body on the wire, compressed or not
+        pub const PAYLOAD_LIMIT: usize = 1_000_000;
+        // maximum decoded json, compressed bodies (Content-Encoding gzip, deflate or br) are
+        // decoded by the json extractor up to this size (ocypod max_body_size is 64MiB)
+        pub const JSON_LIMIT: usize = 8_000_000;
+
+        fn payload_size(req: &HttpRequest) -> Option<usize> {
+            req.headers()
+                .get(header::CONTENT_LENGTH)?
+                .to_str()
+                .ok()?
+                .trim()
+                .parse::<usize>()
+                .ok()
+        }
+
         pub fn hello() -> impl Responder {
             "KVFinder Web"
         }
@@ -520,6 +705,204 @@ mod kv {
             }
         }
 
+        fn get_job_status(
+            client: &reqwest::Client,
+            tag_id: String,
+        ) -> Result<JobStatus, reqwest::Error> {
+            let url = format!("http://ocypod:8023/tag/{}", tag_id);
+            let mut ids: Vec<u32> = client.get(url.as_str()).send()?.json()?;
+            match ids.pop() {
+                // tag_id not found in queue (never created or already expired)
+                None => Ok(JobStatus {
+                    id: tag_id,
+                    status: String::from("not_found"),
+                    created_at: None,
+                    started_at: None,
+                    ended_at: None,
+                    expires_after: None,
+                }),
+                Some(queue_id) => {
+                    let url = format!("http://ocypod:8023/job/{}?fields=status,created_at,started_at,ended_at,expires_after", queue_id);
+                    let mut s: JobStatus = client.get(url.as_str()).send()?.json()?;
+                    s.id = tag_id;
+                    Ok(s)
+                }
+            }
+        }
+
+        // maximum number of ids in a single /status request
+        pub const STATUS_LIMIT: usize = 1000;
+
+        pub fn status(
+            request: web::Json<StatusRequest>,
+            client: web::Data<reqwest::Client>,
+        ) -> impl Future<Item = HttpResponse, Error = actix_web::Error> {
+            let ids = request.into_inner().ids;
+            // each id costs two queue requests, the batch is capped so one request cannot hold a thread for long
+            if ids.len() > STATUS_LIMIT {
+                return Either::A(ok(HttpResponse::BadRequest()
+                    .body(format!("At most {} ids per request", STATUS_LIMIT))));
+            }
+            // shared with /{id}/wait, so its connections to the queue are reused across batches
+            let client = client.get_ref().clone();
+            // the queue requests run on the blocking thread pool, not on the server workers
+            Either::B(web::block(move || {
+                ids.into_iter()
+                    .map(|tag_id| get_job_status(&client, tag_id))
+                    .collect::<Result<Vec<JobStatus>, reqwest::Error>>()
+            }).then(
+                |res: Result<Vec<JobStatus>, BlockingError<reqwest::Error>>| -> Result<HttpResponse, actix_web::Error> {
+                    match res {
+                        Err(e) => Ok(HttpResponse::InternalServerError().body(format!("{:?}", e))),
+                        Ok(s) => Ok(HttpResponse::Ok().json(s)),
+                    }
+                },
+            ))
+        }
+
+        // longest wait accepted by /{id}/wait, in seconds
+        pub const WAIT_LIMIT: u64 = 30;
+        // interval between status checks while waiting, doubled after each check up to WAIT_INTERVAL_MAX
+        const WAIT_INTERVAL: Duration = Duration::from_millis(250);
+        const WAIT_INTERVAL_MAX: Duration = Duration::from_secs(2);
+        // waits in progress, each one holds a thread of the blocking pool
+        static WAITING: AtomicUsize = AtomicUsize::new(0);
+
+        // threads of the blocking pool, sized by actix from ACTIX_THREADPOOL or 5 per core
+        fn blocking_pool_size() -> usize {
+            env::var("ACTIX_THREADPOOL")
+                .ok()
+                .and_then(|s| s.parse().ok())
+                .unwrap_or_else(|| num_cpus::get() * 5)
+        }
+
+        // waits allowed at once, below the blocking pool size so the queue requests of the other handlers
+        // are not stuck behind them: a quarter of the pool (at least 2 threads) is left to those;
+        // KV_WAIT_SLOTS can lower the bound, not raise it
+        fn wait_slots() -> usize {
+            let pool = blocking_pool_size();
+            let slots = pool.saturating_sub((pool / 4).max(2)).max(1);
+            env::var("KV_WAIT_SLOTS")
+                .ok()
+                .and_then(|s| s.parse::<usize>().ok())
+                .map_or(slots, |n| n.min(slots))
+        }
+
+        // one slot of WAITING, given back when the wait ends or is dropped before it runs
+        struct WaitSlot;
+
+        impl WaitSlot {
+            fn take() -> Option<WaitSlot> {
+                if WAITING.fetch_add(1, Ordering::SeqCst) >= wait_slots() {
+                    WAITING.fetch_sub(1, Ordering::SeqCst);
+                    return None;
+                }
+                Some(WaitSlot)
+            }
+        }
+
+        impl Drop for WaitSlot {
+            fn drop(&mut self) {
+                WAITING.fetch_sub(1, Ordering::SeqCst);
+            }
+        }
+
+        fn is_terminal(status: &str) -> bool {
+            match status {
+                "completed" | "failed" | "timed_out" | "cancelled" => true,
+                _ => false,
+            }
+        }
+
+        fn get_queue_status(
+            client: &reqwest::Client,
+            queue_id: u32,
+        ) -> Result<Option<String>, reqwest::Error> {
+            let url = format!("http://ocypod:8023/job/{}?fields=status", queue_id);
+            let mut response = client.get(url.as_str()).send()?;
+            // the job expired while waiting
+            if response.status() == reqwest::StatusCode::NOT_FOUND {
+                return Ok(None);
+            }
+            let s: QueueStatus = response.json()?;
+            Ok(Some(s.status))
+        }
+
+        fn wait_job(
+            client: &reqwest::Client,
+            tag_id: String,
+            timeout: u64,
+            output: bool,
+        ) -> Result<Option<Job>, reqwest::Error> {
+            // the tag is resolved once, then only the status is polled and the output fetched at the end
+            let url = format!("http://ocypod:8023/tag/{}", tag_id);
+            let mut ids: Vec<u32> = client.get(url.as_str()).send()?.json()?;
+            let queue_id = match ids.pop() {
+                None => return Ok(None),
+                Some(queue_id) => queue_id,
+            };
+            let deadline = Instant::now() + Duration::from_secs(timeout);
+            let mut interval = WAIT_INTERVAL;
+            loop {
+                match get_queue_status(client, queue_id)? {
+                    None => return Ok(None),
+                    Some(status) => {
+                        let now = Instant::now();
+                        if is_terminal(&status) || now >= deadline {
+                            break;
+                        }
+                        thread::sleep(interval.min(deadline - now));
+                        interval = (interval * 2).min(WAIT_INTERVAL_MAX);
+                    }
+                }
+            }
+            let fields = if output {
+                "status,output,created_at,started_at,ended_at,expires_after"
+            } else {
+                "status,created_at,started_at,ended_at,expires_after"
+            };
+            let url = format!("http://ocypod:8023/job/{}?fields={}", queue_id, fields);
+            let mut response = client.get(url.as_str()).send()?;
+            if response.status() == reqwest::StatusCode::NOT_FOUND {
+                return Ok(None);
+            }
+            let mut j: Job = response.json()?;
+            j.id = tag_id;
+            Ok(Some(j))
+        }
+
+        pub fn wait(
+            id: web::Path<String>,
+            query: web::Query<WaitQuery>,
+            client: web::Data<reqwest::Client>,
+        ) -> impl Future<Item = HttpResponse, Error = actix_web::Error> {
+            // 429 when every slot is taken, clients check this job through /status instead
+            let slot = match WaitSlot::take() {
+                None => return Either::A(ok(HttpResponse::TooManyRequests().finish())),
+                Some(slot) => slot,
+            };
+            let tag_id = id.into_inner();
+            let timeout = query.timeout.unwrap_or(WAIT_LIMIT).min(WAIT_LIMIT);
+            let output = query.output.unwrap_or(true);
+            let not_found = json!({"id": tag_id.clone(), "status": "not_found"});
+            // shared by every wait, so its connections to the queue are reused
+            let client = client.get_ref().clone();
+            // the queue is polled on the blocking thread pool, not on the server workers
+            Either::B(web::block(move || {
+                let _slot = slot;
+                wait_job(&client, tag_id, timeout, output)
+            }).then(
+                move |res: Result<Option<Job>, BlockingError<reqwest::Error>>| -> Result<HttpResponse, actix_web::Error> {
+                    match res {
+                        Err(e) => Ok(HttpResponse::InternalServerError().body(format!("{:?}", e))),
+                        // 200 with not_found, a 404 means this server has no /wait
+                        Ok(None) => Ok(HttpResponse::Ok().json(not_found)),
+                        Ok(Some(j)) => Ok(HttpResponse::Ok().json(j)),
+                    }
+                },
+            ))
+        }
+
         pub fn ask(id: web::Path<String>) -> impl Responder {
             let tag_id = id.into_inner();
             let job = get_job(tag_id);
@@ -530,9 +913,213 @@ mod kv {
             }
         }
 
-        pub fn create(job_input: web::Json<Input>) -> impl Responder {
+        // one file of a completed job as plain text, so clients can write it to disk in chunks
+        // instead of decoding the whole job json
+        pub fn output(path: web::Path<(String, String)>) -> impl Responder {
+            let (tag_id, name) = path.into_inner();
+            let job = get_job(tag_id);
+            match job {
+                Err(e) => HttpResponse::InternalServerError().body(format!("{:?}", e)),
+                Ok(None) => HttpResponse::NotFound().finish(),
+                // no output until the job is completed
+                Ok(Some(Job { output: None, .. })) => HttpResponse::NotFound().finish(),
+                Ok(Some(Job { output: Some(o), .. })) => {
+                    let text = match name.as_str() {
+                        // Compact jobs have only pdb_kv_compact (read it through /{id}), never an empty file
+                        "pdb_kv" if o.pdb_kv_compact.is_some() => {
+                            return HttpResponse::NotFound().body("pdb_kv is sent as pdb_kv_compact")
+                        }
+                        "pdb_kv" => o.pdb_kv,
+                        "report" => o.report,
+                        "log" => o.log,
+                        _ => return HttpResponse::NotFound().finish(),
+                    };
+                    HttpResponse::Ok()
+                        .content_type("text/plain; charset=utf-8")
+                        .body(text)
+                }
+            }
+        }
+
+        // largest chunk accepted by /upload/{hash}
+        pub const CHUNK_LIMIT: usize = 1_000_000;
+        // largest pdb and pdb_ligand together, once assembled from chunks; with the json escaping the
+        // queued job must still fit in ocypod max_body_size (64MiB)
+        pub const UPLOAD_LIMIT: usize = 50_000_000;
+
+        fn upload_dir() -> PathBuf {
+            PathBuf::from(env::var("KV_UPLOAD_DIR").unwrap_or_else(|_| String::from("/uploads")))
+        }
+
+        // seconds an uploaded chunk is kept (KV_CHUNK_TTL, default one day), resumed uploads reuse it meanwhile
+        fn chunk_ttl() -> Duration {
+            let ttl = env::var("KV_CHUNK_TTL")
+                .ok()
+                .and_then(|s| s.parse::<u64>().ok())
+                .unwrap_or(86_400);
+            Duration::from_secs(ttl)
+        }
+
+        // expired chunks are looked for at most once per SWEEP_INTERVAL seconds, by the upload finding it due
+        const SWEEP_INTERVAL: u64 = 600;
+        static LAST_SWEEP: AtomicU64 = AtomicU64::new(0);
+
+        fn sweep_chunks() {
+            let now = match SystemTime::now().duration_since(UNIX_EPOCH) {
+                Err(_) => return,
+                Ok(d) => d.as_secs(),
+            };
+            let last = LAST_SWEEP.load(Ordering::SeqCst);
+            // only the upload that moves LAST_SWEEP forward sweeps
+            if now < last + SWEEP_INTERVAL
+                || LAST_SWEEP
+                    .compare_exchange(last, now, Ordering::SeqCst, Ordering::SeqCst)
+                    .is_err()
+            {
+                return;
+            }
+            let ttl = chunk_ttl();
+            // off the server workers, a large upload directory takes a while to list
+            thread::spawn(move || {
+                let entries = match fs::read_dir(upload_dir()) {
+                    Err(_) => return,
+                    Ok(entries) => entries,
+                };
+                for entry in entries.filter_map(Result::ok) {
+                    // chunks and the temporary files of interrupted uploads
+                    let expired = entry
+                        .metadata()
+                        .and_then(|m| m.modified())
+                        .ok()
+                        .and_then(|t| t.elapsed().ok())
+                        .map_or(false, |age| age > ttl);
+                    if expired {
+                        let _ = fs::remove_file(entry.path());
+                    }
+                }
+            });
+        }
+
+        fn chunk_path(hash: &str) -> Option<PathBuf> {
+            // hashes are decimal u64 (city::hash64 of the chunk), nothing else may name a file
+            hash.parse::<u64>().ok()?;
+            Some(upload_dir().join(hash))
+        }
+
+        pub fn upload(hash: web::Path<String>, body: web::Bytes) -> impl Responder {
+            let hash = hash.into_inner();
+            let path = match chunk_path(&hash) {
+                None => return HttpResponse::BadRequest().body("Invalid chunk hash"),
+                Some(p) => p,
+            };
+            if city::hash64(&body[..]).to_string() != hash {
+                return HttpResponse::BadRequest().body("Chunk does not match its hash");
+            }
+            sweep_chunks();
+            if path.exists() {
+                return HttpResponse::Ok().json(json!({ "hash": hash }));
+            }
+            // write then rename, so a chunk is never read half written
+            let tmp = upload_dir().join(format!("{}.{:?}.tmp", hash, thread::current().id()));
+            let written = fs::create_dir_all(upload_dir())
+                .and_then(|_| fs::write(&tmp, &body[..]))
+                .and_then(|_| fs::rename(&tmp, &path));
+            match written {
+                Err(e) => HttpResponse::InternalServerError().body(format!("{:?}", e)),
+                Ok(_) => HttpResponse::Ok().json(json!({ "hash": hash })),
+            }
+        }
+
+        // hashes of the request that were not uploaded yet
+        pub fn missing(request: web::Json<ChunksRequest>) -> impl Responder {
+            let missing: Vec<String> = request
+                .into_inner()
+                .hashes
+                .into_iter()
+                .filter(|hash| chunk_path(hash).map_or(true, |p| !p.exists()))
+                .collect();
+            HttpResponse::Ok().json(json!({ "missing": missing }))
+        }
+
+        fn split_lines(text: &str) -> Vec<String> {
+            // lines keep their newline, as the client sent them in pdb
+            let mut lines = Vec::new();
+            let mut start = 0;
+            for (i, _) in text.match_indices('\n') {
+                lines.push(text[start..=i].to_string());
+                start = i + 1;
+            }
+            if start < text.len() {
+                lines.push(text[start..].to_string());
+            }
+            lines
+        }
+
+        fn load_chunks(hashes: &[String], limit: usize) -> Result<Vec<String>, ChunkError> {
+            let mut data: Vec<u8> = Vec::new();
+            let mut missing = Vec::new();
+            for hash in hashes {
+                match chunk_path(hash).map(fs::read) {
+                    Some(Ok(chunk)) => data.extend_from_slice(&chunk),
+                    _ => missing.push(hash.clone()),
+                }
+                if data.len() > limit {
+                    return Err(ChunkError::TooLarge);
+                }
+            }
+            if !missing.is_empty() {
+                return Err(ChunkError::Missing(missing));
+            }
+            let text = String::from_utf8(data).map_err(|_| ChunkError::Invalid)?;
+            Ok(split_lines(&text))
+        }
+
+        fn text_size(lines: &[String]) -> usize {
+            lines.iter().map(|line| line.len()).sum()
+        }
+
+        fn resolve_chunks(input: &mut Input) -> Result<(), ChunkError> {
+            // pdb and pdb_ligand share UPLOAD_LIMIT, whether they were sent inline or in chunks
+            let mut budget = UPLOAD_LIMIT;
+            if input.pdb_chunks.is_none() {
+                budget = budget.saturating_sub(text_size(&input.pdb));
+            }
+            if input.pdb_ligand_chunks.is_none() {
+                if let Some(ligand) = &input.pdb_ligand {
+                    budget = budget.saturating_sub(text_size(ligand));
+                }
+            }
+            if let Some(hashes) = input.pdb_chunks.take() {
+                input.pdb = load_chunks(&hashes, budget)?;
+                budget = budget.saturating_sub(text_size(&input.pdb));
+            }
+            if let Some(hashes) = input.pdb_ligand_chunks.take() {
+                input.pdb_ligand = Some(load_chunks(&hashes, budget)?);
+            }
+            Ok(())
+        }
+
+        pub fn create(req: HttpRequest, job_input: web::Json<Input>) -> impl Responder {
+            // JSON_LIMIT bounds the decoded body, PAYLOAD_LIMIT bounds what was sent; a body sent without
+            // Content-Length (chunked transfer) is only bounded by JSON_LIMIT, checked while it is read
+            if let Some(size) = payload_size(&req) {
+                if size > PAYLOAD_LIMIT {
+                    return HttpResponse::PayloadTooLarge().finish();
+                }
+            }
             // json input values to inp
-            let input = job_input.into_inner();
+            let mut input = job_input.into_inner();
+            // structures uploaded in chunks are assembled first, so they get the same tag as a direct upload
+            match resolve_chunks(&mut input) {
+                Err(ChunkError::Missing(hashes)) => {
+                    return HttpResponse::BadRequest().json(json!({ "missing": hashes }))
+                }
+                Err(ChunkError::TooLarge) => return HttpResponse::PayloadTooLarge().finish(),
+                Err(ChunkError::Invalid) => {
+                    return HttpResponse::BadRequest().body("Chunks are not valid UTF-8")
+                }
+                Ok(_) => (),
+            }
             if let Err(e) = &input.check() {
                 return HttpResponse::BadRequest().body(format!("{:?}", e));
             }